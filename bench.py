@@ -0,0 +1,271 @@
+"""Benchmarks for the lisp interpreter.
+
+Run a benchmark by name, or all of them when no name is given:
+
+    python3 bench.py [NAME ...]
+"""
+
+from __future__ import print_function  # Python 2 compatibility
+
+import gc
+import operator
+import time
+import tracemalloc
+
+import lisp_builtins
+from lisp_builtins import lisp_list, lisp_pmap, lisp_pvec
+from lisp_reader import Pair, nil, make_pair
+from lisp_tokens import count_tokens
+from ucb import main
+
+def best_time(fn, *args, repeat=3):
+    """Return the least time in seconds taken by any of REPEAT calls of FN
+    on ARGS."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def report(name, count, seconds, unit='cells'):
+    """Print the rate at which COUNT UNIT were processed in SECONDS."""
+    print('{0:<28} {1:8.3f} s {2:12,.0f} {3}/s'.format(
+        name, seconds, count / seconds, unit))
+
+# Pairs
+
+def build_checked(n):
+    """Build a lisp list of N numbers with the checking Pair constructor."""
+    s = nil
+    for i in range(n):
+        s = Pair(i, s)
+    return s
+
+def build_unchecked(n):
+    """Build a lisp list of N numbers with make_pair."""
+    s = nil
+    for i in range(n):
+        s = make_pair(i, s)
+    return s
+
+def bench_pairs(n=1000000):
+    """Measure the memory used by a Pair and the rate at which lists of N
+    Pairs are built."""
+    gc.collect()
+    tracemalloc.start()
+    s = nil
+    for _ in range(n):
+        s = make_pair(None, s)
+    size, _ = tracemalloc.get_traced_memory()
+    len(s)  # Marks the list
+    marked, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{0:<28} {1:8.1f} bytes/cell'.format('Pair memory', size / n))
+    print('{0:<28} {1:8.1f} bytes/cell'.format('Pair memory after len',
+                                                 marked / n))
+    s = make_pair(None, s)
+    report('len', 1000, best_time(lambda: [len(s) for _ in range(1000)]),
+           'calls')
+    del s
+    values = list(range(n))
+    report('Pair', n, best_time(build_checked, n))
+    report('make_pair', n, best_time(build_unchecked, n))
+    report('lisp_list', n, best_time(lambda: lisp_list(*values)))
+
+# Persistent maps and vectors
+
+def versions_memory(update, value, n):
+    """Return the bytes used to keep N versions of VALUE, each made by
+    UPDATE from the last."""
+    gc.collect()
+    tracemalloc.start()
+    versions = [value]
+    for i in range(n):
+        versions.append(update(versions[-1], i))
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size
+
+def build_pmap(n):
+    """Build a persistent map of N numbers, one key at a time."""
+    m = lisp_pmap()
+    for i in range(n):
+        m = m.assoc(i, i)
+    return m
+
+def bench_persistent(n=100000, versions=1000):
+    """Measure the rate of updates to persistent maps and vectors of N
+    elements, and the memory used by VERSIONS versions of each compared with
+    copying a list."""
+    report('pmap assoc', n, best_time(build_pmap, n), 'updates')
+    v = lisp_pvec(*range(n))
+    report('pvec assoc', n, best_time(
+        lambda: [v.assoc(i, -i) for i in range(n)]), 'updates')
+    report('pvec conj', n, best_time(lisp_pvec, *range(n)), 'updates')
+    values = list(range(n // 10))
+    for name, value, update in [
+            ('list copy', values, lambda s, i: s[:i] + [-i] + s[i + 1:]),
+            ('pvec', lisp_pvec(*values), lambda s, i: s.assoc(i, -i))]:
+        size = versions_memory(update, value, versions)
+        print('{0:<28} {1:8.1f} bytes/version'.format(name, size / versions))
+
+# Arithmetic
+
+ARITHMETIC = ['+', '-', '*', '/', '<', '=', 'quotient', 'modulo']
+
+def call_pairs(fn, pairs):
+    """Call FN on each pair of operands in PAIRS."""
+    for x, y in pairs:
+        fn(x, y)
+
+def bench_arithmetic(n=200000):
+    """Measure the rate of calls of the arithmetic and comparison builtins
+    on two ints and on two floats, and of the general path of + through
+    _arith."""
+    fns = {name: fn for name, fn, _ in lisp_builtins.BUILTINS}
+    ints = [(i + 1, 7) for i in range(n)]
+    floats = [(i + 0.5, 2.5) for i in range(n)]
+    for name in ARITHMETIC:
+        report(name + ' int', n, best_time(call_pairs, fns[name], ints),
+               'calls')
+        report(name + ' float', n, best_time(call_pairs, fns[name], floats),
+               'calls')
+    general = lambda x, y: lisp_builtins._arith(operator.add, 0, (x, y))
+    report('+ int through _arith', n, best_time(call_pairs, general, ints),
+           'calls')
+
+# Higher-order procedures
+
+MAPPINGS = ['(map (lambda (x) (+ x 1)) s)', '(map - s)', '(map + s s)',
+            '(filter even? s)', '(reduce + s)']
+
+def bench_map(n=100000):
+    """Measure the rate at which map, filter and reduce process the
+    elements of a list of N numbers."""
+    from lisp_interpreter import create_global_frame, lisp_eval, read_line
+    env = create_global_frame()
+    lisp_eval(read_line('(define s (iota {0}))'.format(n)), env)
+    for src in MAPPINGS:
+        expr = read_line(src)
+        report(src, n, best_time(lisp_eval, expr, env), 'elements')
+
+# Tokens
+
+SOURCE = """; Procedure {0}
+(define (f{0} x [y 2.5])
+  (cond ((< x {0}) (list 'a-{0} "line {0}\\n" #t))
+        (else `(,x ,@(map - y) -{0} #(1 2 3)))))  ; done
+"""
+
+def bench_tokens(size=4000000):
+    """Measure the rate at which count_tokens reads lines of source code,
+    SIZE characters in all."""
+    lines, total = [], 0
+    while total < size:
+        text = SOURCE.format(len(lines))
+        lines.extend(text.splitlines(True))
+        total += len(text)
+    seconds = best_time(count_tokens, lines)
+    mb = sum(len(line.encode('utf-8')) for line in lines) / 1e6
+    print('{0:<28} {1:8.3f} s {2:12,.1f} MB/s'.format(
+        'count_tokens', seconds, mb / seconds))
+
+# Loading
+
+LIBRARY = """; Procedure {0}
+(define (g{0} x)
+  (if (< x {0}) (list 'a-{0} "line {0}\\n" #t) '(#(1 2.5 "three") -{0})))
+"""
+
+def bench_load(size=2000000):
+    """Measure the rate at which load reads a file of SIZE characters of
+    source code, from the source and from its cache entry."""
+    import contextlib
+    import io
+    import os
+    import tempfile
+    import lisp_interpreter
+    from lisp_tokens import String
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'source.scm')
+        with open(filename, 'w') as outfile:
+            total = 0
+            while total < size:
+                total += outfile.write(LIBRARY.format(total))
+        mb = total / 1e6
+        env = lisp_interpreter.create_global_frame()
+        def load(cache):
+            lisp_interpreter.LOAD_CACHE = cache
+            with contextlib.redirect_stdout(io.StringIO()):
+                lisp_interpreter.lisp_load(String(filename), env)
+        for name, cache in [('source', False), ('cache', True)]:
+            load(cache)  # Write the cache entry
+            seconds = best_time(load, cache)
+            print('{0:<28} {1:8.3f} s {2:12,.1f} MB/s'.format(
+                'load from ' + name, seconds, mb / seconds))
+        lisp_interpreter.LOAD_CACHE = True
+
+# Startup
+
+def bench_startup(n=20, top=8):
+    """Measure the time taken to start the interpreter and evaluate an empty
+    file, the least of N runs, and list the TOP modules that take the most
+    time to import, as python -X importtime reports them."""
+    import subprocess
+    import sys
+    import tempfile
+    def run(*args):
+        subprocess.run([sys.executable] + list(args), check=True,
+                       stdout=subprocess.DEVNULL)
+    with tempfile.NamedTemporaryFile('w', suffix='.scm') as empty:
+        run('lisp_interpreter.py', empty.name)  # Compile the modules
+        for name, args in [('python', ('-c', '')),
+                           ('lisp_interpreter', ('lisp_interpreter.py',
+                                                 empty.name))]:
+            seconds = best_time(run, *args, repeat=n)
+            print('{0:<28} {1:8.3f} s'.format('start ' + name, seconds))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import lisp_interpreter'],
+        stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    imports = []  # Pairs of cumulative import time in us and module name
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            imports.append((int(fields[1]), fields[2].strip()))
+    for us, name in sorted(imports, reverse=True)[:top]:
+        print('{0:<28} {1:8.3f} s'.format('import ' + name, us / 1e6))
+
+# Parallelism
+
+def bench_parallel(n=64, size=18):
+    """Measure the rate at which map and parallel-map apply a recursive
+    procedure that takes about a millisecond to N inputs."""
+    from lisp_interpreter import (create_global_frame, lisp_eval, pool_size,
+                                  read_line)
+    env = create_global_frame()
+    lisp_eval(read_line('(define (fib n) (if (< n 2) n '
+                        '(+ (fib (- n 1)) (fib (- n 2)))))'), env)
+    lisp_eval(read_line('(define s (map (lambda (x) {0}) (iota {1})))'.format(
+        size, n)), env)
+    lisp_eval(read_line('(parallel-map fib s)'), env)  # Start the workers
+    print('{0:<28} {1:8d}'.format('workers', pool_size()))
+    for src in ['(map fib s)', '(parallel-map fib s)', '(parallel-map fib s 1)']:
+        report(src, n, best_time(lisp_eval, read_line(src), env), 'calls')
+
+BENCHMARKS = {
+    'arithmetic': bench_arithmetic,
+    'load': bench_load,
+    'map': bench_map,
+    'parallel': bench_parallel,
+    'pairs': bench_pairs,
+    'persistent': bench_persistent,
+    'startup': bench_startup,
+    'tokens': bench_tokens,
+}
+
+@main
+def run(*names):
+    for name in names or sorted(BENCHMARKS):
+        print('#', name)
+        BENCHMARKS[name]()
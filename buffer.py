@@ -2,6 +2,7 @@
 
 from __future__ import print_function  # Python 2 compatibility
 
+import collections
 import math
 import sys
 
@@ -27,8 +28,9 @@ class Buffer(object):
     In addition, Buffer provides a current method to look at the
     next item to be supplied, without sequencing past it.
 
-    The __str__ method prints all tokens read so far, up to the end of the
-    current line, and marks the current token with >>.
+    The __str__ method prints the tokens of the current line read so far,
+    and of up to three lines before it, and marks the current token with >>.
+    Only those lines are kept.
 
     >>> buf = Buffer(iter([['(', '+'], [15], [12, ')']]))
     >>> buf.remove_front()
@@ -60,7 +62,8 @@ class Buffer(object):
     """
     def __init__(self, source):
         self.index = 0
-        self.lines = []
+        self.lines = collections.deque(maxlen=4)  # The last lines read
+        self.line_number = 0
         self.source = source
         self.current_line = ()
         self.current()
@@ -79,6 +82,7 @@ class Buffer(object):
             try:
                 self.current_line = next(self.source)
                 self.lines.append(self.current_line)
+                self.line_number += 1
             except StopIteration:
                 self.current_line = ()
                 return None
@@ -91,13 +95,14 @@ class Buffer(object):
     def __str__(self):
         """Return recently read contents; current element marked with >>."""
         # Format string for right-justified line numbers
-        n = len(self.lines)
+        n = self.line_number
         msg = '{0:>' + str(math.floor(math.log10(n))+1) + "}: "
 
         # Up to three previous lines and current line are included in output
         s = ''
-        for i in range(max(0, n-4), n-1):
-            s += msg.format(i+1) + ' '.join(map(str, self.lines[i])) + '\n'
+        previous = list(self.lines)[:-1]
+        for i, line in enumerate(previous, n - len(previous)):
+            s += msg.format(i) + ' '.join(map(str, line)) + '\n'
         s += msg.format(n)
         s += ' '.join(map(str, self.current_line[:self.index]))
         s += ' >> '
@@ -121,15 +126,17 @@ class InputReader(object):
             self.prompt = ' ' * len(self.prompt)
 
 class LineReader(object):
-    """A LineReader is an iterable that prints lines after a prompt."""
+    """A LineReader is an iterable that prints lines after a prompt. Its
+    LINES are read from an iterator, such as an open file, which may be
+    shared by several LineReaders: each takes up where the last left off."""
     def __init__(self, lines, prompt, comment=";"):
         self.lines = lines
         self.prompt = prompt
         self.comment = comment
 
     def __iter__(self):
-        while self.lines:
-            line = self.lines.pop(0).strip('\n')
+        for line in self.lines:
+            line = line.strip('\n')
             if (self.prompt is not None and line != "" and
                 not line.lstrip().startswith(self.comment)):
                 print(self.prompt + line)
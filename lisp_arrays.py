@@ -0,0 +1,189 @@
+"""Numeric arrays for the lisp language.
+
+An array is a fixed-length sequence of floats. When NumPy is installed,
+arrays are NumPy arrays and arithmetic on them runs in NumPy; otherwise
+they are arrays from the array module and arithmetic runs in Python, one
+element at a time. NumPy is optional, and it is imported only when the first
+array is made, so programs without arrays do not wait for it. Setting the
+environment variable LISP_NO_NUMPY makes arrays run in Python even when
+NumPy is installed.
+
+Either way, the functions in this module broadcast: a number is combined
+with every element of an array. They raise ArithmeticError when an element
+of the result would overflow or be undefined, and ValueError when arrays of
+different lengths are combined.
+"""
+
+from __future__ import print_function  # Python 2 compatibility
+
+import array
+import math
+import operator
+import os
+
+numpy = None  # The numpy module, once the first array has imported it
+ARRAY_TYPE = array.array  # The type of arrays, numpy.ndarray with NumPy
+_numpy_checked = False  # Whether make_array has tried to import NumPy
+
+# The NumPy functions that compute the math module functions of other names
+NUMPY_NAMES = {'acos': 'arccos', 'acosh': 'arccosh', 'asin': 'arcsin',
+               'asinh': 'arcsinh', 'atan': 'arctan', 'atan2': 'arctan2',
+               'atanh': 'arctanh', 'pow': 'power'}
+
+# The lisp names of the operators that broadcast applies
+OPERATOR_NAMES = {operator.add: '+', operator.sub: '-', operator.mul: '*',
+                  operator.truediv: '/', pow: 'expt'}
+
+def _import_numpy():
+    """Use NumPy for arrays if it is installed and not disabled."""
+    global numpy, ARRAY_TYPE, _numpy_checked
+    _numpy_checked = True
+    if os.environ.get('LISP_NO_NUMPY'):
+        return
+    try:
+        import numpy
+    except ImportError:
+        return
+    ARRAY_TYPE = numpy.ndarray
+
+def is_array(x):
+    """Return whether X is an array."""
+    return isinstance(x, ARRAY_TYPE)
+
+def make_array(values):
+    """Return a new array of the numbers in the iterable VALUES.
+
+    >>> [float(x) for x in make_array([1, 2.5])]
+    [1.0, 2.5]
+    """
+    if not _numpy_checked:
+        _import_numpy()
+    if numpy is not None:
+        return numpy.array(list(values), dtype=float)
+    return array.array('d', values)
+
+def _length(vals):
+    """Return the length shared by the arrays in VALS, raising ValueError if
+    they differ."""
+    lengths = {len(v) for v in vals if is_array(v)}
+    if len(lengths) > 1:
+        raise ValueError('arrays of different lengths: {0}'.format(
+            ', '.join(str(n) for n in sorted(lengths))))
+    return lengths.pop()
+
+def _compute(name, fn, vals):
+    """Return FN applied to the elements of the arrays and numbers VALS, one
+    element at a time, as an array."""
+    n = _length(vals)
+    columns = [v if is_array(v) else [v] * n for v in vals]
+    try:
+        results = array.array('d', map(fn, *columns))
+    except (ArithmeticError, ValueError):
+        results = None
+    if results is None or any(math.isinf(x) for x in results) and not any(
+            math.isinf(x) for column in columns for x in column):
+        raise ArithmeticError('arithmetic error in {0}'.format(name))
+    return results
+
+def broadcast(fn, x, y):
+    """Return FN applied to the elements of X and Y, either of which may be
+    an array or a number.
+
+    >>> [float(z) for z in broadcast(operator.add, make_array([1, 2]), 10)]
+    [11.0, 12.0]
+    >>> broadcast(operator.mul, make_array([1e200]), 1e200)
+    Traceback (most recent call last):
+        ...
+    ArithmeticError: arithmetic error in *
+    """
+    if not (is_array(x) or is_array(y)):
+        return fn(x, y)
+    name = OPERATOR_NAMES.get(fn, getattr(fn, '__name__', 'arithmetic'))
+    if numpy is None:
+        return _compute(name, math.pow if fn is pow else fn, (x, y))
+    _length((x, y))
+    try:
+        with numpy.errstate(all='raise', under='ignore'):
+            return fn(x, y)
+    except FloatingPointError:
+        raise ArithmeticError('arithmetic error in {0}'.format(name))
+
+def elementwise(name, fn, vals):
+    """Return the math function NAME, which is FN in Python, applied to the
+    elements of VALS, some of which are arrays.
+
+    >>> [float(z) for z in elementwise('sqrt', math.sqrt, [make_array([4, 9])])]
+    [2.0, 3.0]
+    >>> [float(z) for z in elementwise('log', math.log, [make_array([8]), 2])]
+    [3.0]
+    """
+    if name == 'log' and len(vals) == 2:
+        # NumPy's log has no base, so divide by the logarithm of the base
+        logs = [elementwise(name, fn, [v]) if is_array(v) else fn(v)
+                for v in vals]
+        return broadcast(operator.truediv, *logs)
+    ufunc = None
+    if numpy is not None:
+        ufunc = getattr(numpy, NUMPY_NAMES.get(name, name), None)
+    if ufunc is None:
+        results = _compute(name, fn, vals)
+        return make_array(results) if numpy is not None else results
+    _length(vals)
+    try:
+        with numpy.errstate(all='raise', under='ignore'):
+            return ufunc(*vals)
+    except FloatingPointError:
+        raise ArithmeticError('arithmetic error in {0}'.format(name))
+
+def to_list(a):
+    """Return the elements of array A as a list of Python floats."""
+    return [float(x) for x in a]
+
+def slice_array(a, start, end, step=1):
+    """Return a new array of the elements of A from START up to END, taking
+    every STEPth element.
+
+    >>> to_list(slice_array(make_array(range(6)), 1, 6, 2))
+    [1.0, 3.0, 5.0]
+    """
+    return make_array(a[start:end:step])
+
+def total(a):
+    """Return the sum of the elements of A."""
+    if numpy is not None:
+        return float(numpy.sum(a))
+    return math.fsum(a)
+
+def product(a):
+    """Return the product of the elements of A."""
+    if numpy is not None:
+        return float(numpy.prod(a))
+    result = 1.0
+    for x in a:
+        result *= x
+    return result
+
+def minimum(a):
+    """Return the least element of A, which is not empty."""
+    if numpy is not None:
+        return float(numpy.min(a))
+    return float(min(a))
+
+def maximum(a):
+    """Return the greatest element of A, which is not empty."""
+    if numpy is not None:
+        return float(numpy.max(a))
+    return float(max(a))
+
+def dot(a, b):
+    """Return the dot product of arrays A and B.
+
+    >>> dot(make_array([1, 2, 3]), make_array([4, 5, 6]))
+    32.0
+    """
+    if len(a) != len(b):
+        raise ValueError('arrays of different lengths: {0}, {1}'.format(
+            len(a), len(b)))
+    if numpy is not None:
+        return float(numpy.dot(a, b))
+    return math.fsum(map(operator.mul, a, b))
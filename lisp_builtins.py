@@ -2,21 +2,19 @@
 
 from __future__ import print_function  # Python 2 compatibility
 
+import functools
+import importlib
+import inspect
 import math
 import numbers
 import operator
 import sys
-from lisp_reader import Pair, nil, repl_str
-import lisp_interpreter
-
-try:
-    import turtle
-    import tkinter
-except:
-    print("warning: could not import the turtle module.", file=srys.stderr)
-
-class lispError(Exception):
-    """Exception indicating an error in a lisp program."""
+from lisp_arrays import (is_array, make_array, broadcast, elementwise, to_list,
+                         slice_array, total, product, minimum, maximum, dot)
+from lisp_persistent import PersistentMap, PersistentVector
+from lisp_reader import (Pair, nil, repl_str, lispError, make_pair, set_first,
+                         set_second, mutated, lisp_hash, Symbol, String,
+                         Vector)
 
 # Built-In Procedures
 # A list of triples (NAME, PYTHON-FUNCTION, INTERNAL-NAME).  Added to by
@@ -24,13 +22,42 @@ class lispError(Exception):
 BUILTINS = []
 
 def builtin(*names):
-    """An annotation to convert a Python function into a BuiltinProcedure."""
+    """An annotation to convert a Python function into a BuiltinProcedure.
+    The arity of the procedure is that of the function, unless the function
+    declares another with an ARITY attribute. A function that sets its
+    USE_ENV attribute to True also takes the environment of the call."""
     def add(fn):
+        if not hasattr(fn, 'arity'):
+            fn.arity = function_arity(fn)
         for name in names:
             BUILTINS.append((name, fn, names[0]))
         return fn
     return add
 
+def function_arity(fn):
+    """Return the least and greatest numbers of arguments that Python
+    function FN accepts, where the greatest is None if there is no limit.
+
+    >>> function_arity(lambda x, y=1: x), function_arity(lambda x, *y: x)
+    ((1, 2), (1, None))
+    """
+    if hasattr(fn, 'arity'):
+        return fn.arity
+    try:
+        parameters = inspect.signature(fn).parameters.values()
+    except ValueError:  # Some functions implemented in C have no signature
+        return 0, None
+    least, greatest = 0, 0
+    for p in parameters:
+        if p.kind == p.VAR_POSITIONAL:
+            greatest = None
+        elif p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD):
+            if p.default is p.empty:
+                least += 1
+            if greatest is not None:
+                greatest += 1
+    return least, greatest
+
 def check_type(val, predicate, k, name):
     """Returns VAL.  Raises a lispError if not PREDICATE(VAL)
     using "argument K of NAME" to describe the offending value."""
@@ -59,6 +86,16 @@ def lisp_not(x):
 def lisp_equalp(x, y):
     if lisp_pairp(x) and lisp_pairp(y):
         return lisp_equalp(x.first, y.first) and lisp_equalp(x.second, y.second)
+    elif lisp_vectorp(x) and lisp_vectorp(y):
+        return len(x) == len(y) and all(map(lisp_equalp, x, y))
+    elif lisp_arrayp(x) and lisp_arrayp(y):
+        return len(x) == len(y) and all(map(operator.eq, x, y))
+    elif lisp_pvecp(x) and lisp_pvecp(y):
+        return len(x) == len(y) and all(map(lisp_equalp, x, y))
+    elif lisp_pmapp(x) and lisp_pmapp(y):
+        return len(x) == len(y) and all(
+            lisp_equalp(value, y.get(key, _no_default))
+            for key, value in x.items())
     elif lisp_numberp(x) and lisp_numberp(y):
         return x == y
     else:
@@ -68,8 +105,6 @@ def lisp_equalp(x, y):
 def lisp_eqp(x, y):
     if lisp_numberp(x) and lisp_numberp(y):
         return x == y
-    elif lisp_symbolp(x) and lisp_symbolp(y):
-        return x == y
     else:
         return x is y
 
@@ -103,11 +138,9 @@ def lisp_nullp(x):
 @builtin("list?")
 def lisp_listp(x):
     """Return whether x is a well-formed list. Assumes no cycles."""
-    while x is not nil:
-        if not isinstance(x, Pair):
-            return False
-        x = x.second
-    return True
+    if x is nil:
+        return True
+    return isinstance(x, Pair) and x.list_length() is not None
 
 @builtin("length")
 def lisp_length(x):
@@ -134,19 +167,19 @@ def lisp_cdr(x):
 @builtin("set-car!")
 def lisp_car(x, y):
     check_type(x, lisp_pairp, 0, 'set-car!')
-    x.first = y
+    set_first(x, y)
 
 @builtin("set-cdr!")
 def lisp_cdr(x, y):
     check_type(x, lisp_pairp, 0, 'set-cdr!')
     check_type(y, lisp_valid_cdrp, 1, 'set-cdr!')
-    x.second = y
+    set_second(x, y)
 
 @builtin("list")
 def lisp_list(*vals):
     result = nil
     for e in reversed(vals):
-        result = Pair(e, result)
+        result = make_pair(e, result)
     return result
 
 @builtin("append")
@@ -158,31 +191,329 @@ def lisp_append(*vals):
         v = vals[i]
         if v is not nil:
             check_type(v, lisp_pairp, i, 'append')
-            r = p = Pair(v.first, result)
-            v = v.second
+            items = []
             while lisp_pairp(v):
-                p.second = Pair(v.first, result)
-                p = p.second
+                items.append(v.first)
                 v = v.second
-            result = r
+            result = Pair(items.pop(), result)
+            for item in reversed(items):
+                result = make_pair(item, result)
+    return result
+
+# List library
+def list_items(s, k, name):
+    """Return the elements of S, argument K of NAME, which must be a list,
+    as a Python list."""
+    check_type(s, lisp_listp, k, name)
+    items = []
+    while s is not nil:
+        items.append(s.first)
+        s = s.second
+    return items
+
+def _check_count(k, name):
+    """Check that K, argument 1 of NAME, is a count of list elements, and
+    return it as an int."""
+    check_type(k, _is_size, 1, name)
+    return int(k)
+
+@builtin("reverse")
+def lisp_reverse(s):
+    check_type(s, lisp_listp, 0, 'reverse')
+    result = nil
+    while s is not nil:
+        result = make_pair(s.first, result)
+        s = s.second
+    return result
+
+def _list_tail(s, k, name):
+    """Return the list that remains of S, argument 0 of NAME, after its
+    first K elements."""
+    for _ in range(_check_count(k, name)):
+        if not lisp_pairp(s):
+            raise lispError('index {0} out of range for {1}'.format(k, name))
+        s = s.second
+    return s
+
+@builtin("list-tail")
+def lisp_list_tail(s, k):
+    return _list_tail(s, k, 'list-tail')
+
+@builtin("drop")
+def lisp_drop(s, k):
+    return _list_tail(s, k, 'drop')
+
+@builtin("list-ref")
+def lisp_list_ref(s, k):
+    s = _list_tail(s, k, 'list-ref')
+    if not lisp_pairp(s):
+        raise lispError('index {0} out of range for list-ref'.format(k))
+    return s.first
+
+@builtin("take")
+def lisp_take(s, k):
+    items = []
+    for _ in range(_check_count(k, 'take')):
+        if not lisp_pairp(s):
+            raise lispError('index {0} out of range for take'.format(k))
+        items.append(s.first)
+        s = s.second
+    return lisp_list(*items)
+
+@builtin("last")
+def lisp_last(s):
+    check_type(s, lisp_pairp, 0, 'last')
+    while lisp_pairp(s.second):
+        s = s.second
+    return s.first
+
+@builtin("member")
+def lisp_member(x, s):
+    check_type(s, lisp_listp, 1, 'member')
+    while s is not nil:
+        if lisp_equalp(x, s.first):
+            return s
+        s = s.second
+    return False
+
+@builtin("assoc")
+def lisp_assoc(x, s):
+    check_type(s, lisp_listp, 1, 'assoc')
+    while s is not nil:
+        check_type(s.first, lisp_pairp, 1, 'assoc')
+        if lisp_equalp(x, s.first.first):
+            return s.first
+        s = s.second
+    return False
+
+@builtin("iota")
+def lisp_iota(count, start=0, step=1):
+    check_type(count, _is_size, 0, 'iota')
+    check_type(start, lisp_numberp, 1, 'iota')
+    check_type(step, lisp_numberp, 2, 'iota')
+    result = nil
+    for i in range(int(count) - 1, -1, -1):
+        result = make_pair(start + i * step, result)
     return result
 
+def _procedure_caller(fn, k, n, env, name):
+    """Return a Python function that applies FN, argument K of NAME and a
+    lisp procedure, to N arguments in ENV. Procedures are applied by
+    lisp_interpreter, which imports this module, so its procedure_caller is
+    imported here when first used."""
+    from lisp_interpreter import lisp_procedurep, procedure_caller
+    check_type(fn, lisp_procedurep, k, name)
+    return procedure_caller(fn, n, env, name)
+
+@builtin("fold-left")
+def lisp_fold_left(fn, init, *args):
+    lists, env = args[:-1], args[-1]
+    columns = [list_items(s, i + 2, 'fold-left') for i, s in enumerate(lists)]
+    call = _procedure_caller(fn, 0, len(lists) + 1, env, 'fold-left')
+    value = init
+    for vals in zip(*columns):
+        value = call(value, *vals)
+    return value
+
+lisp_fold_left.arity = (4, None)  # FN, INIT, one or more lists, and env
+lisp_fold_left.use_env = True
+
+@builtin("fold-right")
+def lisp_fold_right(fn, init, *args):
+    lists, env = args[:-1], args[-1]
+    columns = [list_items(s, i + 2, 'fold-right') for i, s in enumerate(lists)]
+    call = _procedure_caller(fn, 0, len(lists) + 1, env, 'fold-right')
+    value = init
+    for vals in reversed(list(zip(*columns))):
+        value = call(*(vals + (value,)))
+    return value
+
+lisp_fold_right.arity = lisp_fold_left.arity
+lisp_fold_right.use_env = True
+
+@builtin("sort")
+def lisp_sort(s, less, env):
+    """Return the elements of list or vector S in a new list or vector,
+    stably sorted by the procedure LESS."""
+    items = list(s) if lisp_vectorp(s) else list_items(s, 0, 'sort')
+    call = _procedure_caller(less, 1, 2, env, 'sort')
+    def compare(x, y):
+        return 0 if call(x, y) is False else -1
+    items.sort(key=functools.cmp_to_key(compare))
+    return Vector(items) if lisp_vectorp(s) else lisp_list(*items)
+
+lisp_sort.use_env = True
+
+# Vectors
+@builtin("vector?")
+def lisp_vectorp(x):
+    """Return whether X is a vector. Other Python lists are not vectors.
+
+    >>> lisp_vectorp(Vector([1, 2])), lisp_vectorp([1, 2])
+    (True, False)
+    """
+    return type(x) is Vector
+
+def _check_index(v, k, name, predicate=lisp_vectorp):
+    """Check that K is a valid index of V, a vector or whatever satisfies
+    PREDICATE, and return it as an int."""
+    check_type(v, predicate, 0, name)
+    check_type(k, lisp_integerp, 1, name)
+    if not 0 <= k < len(v):
+        raise lispError('index {0} out of range for {1}'.format(k, name))
+    return int(k)
+
+@builtin("make-vector")
+def lisp_make_vector(k, fill=0):
+    check_type(k, _is_size, 0, 'make-vector')
+    return Vector([fill] * int(k))
+
+@builtin("vector")
+def lisp_vector(*vals):
+    return Vector(vals)
+
+@builtin("vector-ref")
+def lisp_vector_ref(v, k):
+    return v[_check_index(v, k, 'vector-ref')]
+
+@builtin("vector-set!")
+def lisp_vector_set(v, k, val):
+    v[_check_index(v, k, 'vector-set!')] = val
+    mutated()
+
+@builtin("vector-length")
+def lisp_vector_length(v):
+    check_type(v, lisp_vectorp, 0, 'vector-length')
+    return len(v)
+
+@builtin("vector-fill!")
+def lisp_vector_fill(v, fill):
+    check_type(v, lisp_vectorp, 0, 'vector-fill!')
+    v[:] = [fill] * len(v)
+    mutated()
+
+@builtin("vector->list")
+def lisp_vector_to_list(v):
+    check_type(v, lisp_vectorp, 0, 'vector->list')
+    return lisp_list(*v)
+
+@builtin("list->vector")
+def lisp_list_to_vector(s):
+    return Vector(list_items(s, 0, 'list->vector'))
+
+# Hash tables
+class EqualKey(object):
+    """A key of a hash table that is the same as any other key that is
+    equal? to it."""
+    __slots__ = ('value', 'hash')
+
+    def __init__(self, value):
+        self.value = value
+        self.hash = lisp_hash(value)
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return lisp_equalp(self.value, other.value)
+
+class EqKey(EqualKey):
+    """A key of a hash table that is the same as any other key that is
+    eq? to it."""
+    __slots__ = ()
+
+    def __init__(self, value):
+        self.value = value
+        if lisp_numberp(value):
+            self.hash = hash(value)
+        else:
+            self.hash = id(value)
+
+    __hash__ = EqualKey.__hash__
+
+    def __eq__(self, other):
+        return lisp_eqp(self.value, other.value)
+
+class HashTable(object):
+    """A mutable table of values, in which keys are compared with equal?
+    or, if KEY is EqKey, with eq?."""
+    __slots__ = ('entries', 'key')
+
+    def __init__(self, key=EqualKey):
+        self.entries = {}
+        self.key = key
+
+    def __str__(self):
+        return '#[hash-table {0}]'.format(len(self.entries))
+
+_no_default = object()
+
+@builtin("hash-table?")
+def lisp_hash_tablep(x):
+    return isinstance(x, HashTable)
+
+@builtin("make-hash-table")
+def lisp_make_hash_table(test=None):
+    fn = getattr(test, 'fn', test)  # The Python function of a builtin
+    if test is None or fn is lisp_equalp:
+        return HashTable(EqualKey)
+    elif fn is lisp_eqp:
+        return HashTable(EqKey)
+    raise lispError('make-hash-table requires eq? or equal?')
+
+@builtin("hash-table-ref")
+def lisp_hash_table_ref(table, key, default=_no_default):
+    check_type(table, lisp_hash_tablep, 0, 'hash-table-ref')
+    value = table.entries.get(table.key(key), default)
+    if value is _no_default:
+        raise lispError('key not found: {0}'.format(repl_str(key)))
+    return value
+
+@builtin("hash-table-set!")
+def lisp_hash_table_set(table, key, value):
+    check_type(table, lisp_hash_tablep, 0, 'hash-table-set!')
+    table.entries[table.key(key)] = value
+
+@builtin("hash-table-delete!")
+def lisp_hash_table_delete(table, key):
+    check_type(table, lisp_hash_tablep, 0, 'hash-table-delete!')
+    table.entries.pop(table.key(key), None)
+
+@builtin("hash-table-count")
+def lisp_hash_table_count(table):
+    check_type(table, lisp_hash_tablep, 0, 'hash-table-count')
+    return len(table.entries)
+
+@builtin("hash-table-keys")
+def lisp_hash_table_keys(table):
+    check_type(table, lisp_hash_tablep, 0, 'hash-table-keys')
+    return lisp_list(*[key.value for key in table.entries])
+
 @builtin("string?")
 def lisp_stringp(x):
-    return isinstance(x, str) and x.startswith('"')
+    return type(x) is String
 
 @builtin("symbol?")
 def lisp_symbolp(x):
-    return isinstance(x, str) and not lisp_stringp(x)
+    return type(x) is Symbol
+
 
+# The types of nearly all numbers, which builtins check for first
+_FAST_NUMBERS = frozenset([int, float])
 
 @builtin("number?")
 def lisp_numberp(x):
-    return isinstance(x, numbers.Real) and not lisp_booleanp(x)
+    return type(x) in _FAST_NUMBERS or (isinstance(x, numbers.Real) and
+                                        not lisp_booleanp(x))
 
 @builtin("integer?")
 def lisp_integerp(x):
-    return lisp_numberp(x) and (isinstance(x, numbers.Integral) or int(x) == x)
+    return lisp_numberp(x) and (isinstance(x, numbers.Integral) or
+                                math.isfinite(x) and int(x) == x)
+
+def _is_size(x):
+    """Return whether X is an integer that can be the size of a list."""
+    return lisp_integerp(x) and 0 <= x <= sys.maxsize
 
 def _check_nums(*vals):
     """Check that all arguments in VALS are numbers."""
@@ -191,37 +522,102 @@ def _check_nums(*vals):
             msg = "operand {0} ({1}) is not a number"
             raise lispError(msg.format(i, v))
 
+def _check_operands(*vals):
+    """Check that all arguments in VALS are numbers or arrays, and return
+    whether any of them is an array."""
+    arrays = False
+    for i, v in enumerate(vals):
+        if not lisp_numberp(v):
+            if not lisp_arrayp(v):
+                msg = "operand {0} ({1}) is not a number"
+                raise lispError(msg.format(i, v))
+            arrays = True
+    return arrays
+
+def _broadcast(fn, x, y):
+    """Return broadcast(FN, X, Y), reporting its errors as lispErrors."""
+    try:
+        return broadcast(fn, x, y)
+    except (ArithmeticError, ValueError) as err:
+        raise lispError(err)
+
+def _elementwise(name, fn, vals):
+    """Return elementwise(NAME, FN, VALS), reporting its errors as
+    lispErrors."""
+    try:
+        return elementwise(name, fn, vals)
+    except (ArithmeticError, ValueError) as err:
+        raise lispError(err)
+
 def _arith(fn, init, vals):
     """Perform the FN operation on the number values of VALS, with INIT as
-    the value when VALS is empty. Returns the result as a lisp value."""
-    _check_nums(*vals)
+    the value when VALS is empty. Returns the result as a lisp value. If any
+    value is an array, the operation is applied to each of its elements."""
+    if _check_operands(*vals) or lisp_arrayp(init):
+        s = init
+        for val in vals:
+            s = _broadcast(fn, s, val)
+        return s
     s = init
     for val in vals:
         s = fn(s, val)
-    if int(s) == s:
+    if isinstance(s, float) and s.is_integer():
         s = int(s)
     return s
 
+# The + - * / builtins first try the common case of two ints or floats,
+# which gives the same result as _arith without its checks.
+
 @builtin("+")
 def lisp_add(*vals):
+    if len(vals) == 2:
+        x, y = vals
+        if type(x) is int and type(y) is int:
+            return x + y
+        if type(x) in _FAST_NUMBERS and type(y) in _FAST_NUMBERS:
+            s = x + y
+            return int(s) if s.is_integer() else s
     return _arith(operator.add, 0, vals)
 
 @builtin("-")
 def lisp_sub(val0, *vals):
-    _check_nums(val0, *vals) # fixes off-by-one error
+    if len(vals) == 1:
+        y = vals[0]
+        if type(val0) is int and type(y) is int:
+            return val0 - y
+        if type(val0) in _FAST_NUMBERS and type(y) in _FAST_NUMBERS:
+            s = val0 - y
+            return int(s) if s.is_integer() else s
+    arrays = _check_operands(val0, *vals) # fixes off-by-one error
     if len(vals) == 0:
-        return -val0
+        return _broadcast(operator.sub, 0, val0) if arrays else -val0
     return _arith(operator.sub, val0, vals)
 
 @builtin("*")
 def lisp_mul(*vals):
+    if len(vals) == 2:
+        x, y = vals
+        if type(x) is int and type(y) is int:
+            return x * y
+        if type(x) in _FAST_NUMBERS and type(y) in _FAST_NUMBERS:
+            s = x * y
+            return int(s) if s.is_integer() else s
     return _arith(operator.mul, 1, vals)
 
 @builtin("/")
 def lisp_div(val0, *vals):
-    _check_nums(val0, *vals) # fixes off-by-one error
+    if (len(vals) == 1 and type(val0) in _FAST_NUMBERS and
+            type(vals[0]) in _FAST_NUMBERS):
+        try:
+            s = val0 / vals[0]
+        except ZeroDivisionError as err:
+            raise lispError(err)
+        return int(s) if s.is_integer() else s
+    arrays = _check_operands(val0, *vals) # fixes off-by-one error
     try:
         if len(vals) == 0:
+            if arrays:
+                return _broadcast(operator.truediv, 1, val0)
             return operator.truediv(1, val0)
         return _arith(operator.truediv, val0, vals)
     except ZeroDivisionError as err:
@@ -229,16 +625,23 @@ def lisp_div(val0, *vals):
 
 @builtin("expt")
 def lisp_expt(val0, val1):
-    _check_nums(val0, val1)
-    return pow(val0, val1)
+    if _check_operands(val0, val1):
+        return _broadcast(pow, val0, val1)
+    try:
+        return pow(val0, val1)
+    except ArithmeticError as err:
+        raise lispError(err)
 
 @builtin("abs")
 def lisp_abs(val0):
+    if _check_operands(val0):
+        return _elementwise('abs', abs, [val0])
     return abs(val0)
 
 @builtin("quotient")
 def lisp_quo(val0, val1):
-    _check_nums(val0, val1)
+    if not (type(val0) in _FAST_NUMBERS and type(val1) in _FAST_NUMBERS):
+        _check_nums(val0, val1)
     try:
         return -(-val0 // val1) if (val0 < 0) ^ (val1 < 0) else val0 // val1
     except ZeroDivisionError as err:
@@ -246,7 +649,8 @@ def lisp_quo(val0, val1):
 
 @builtin("modulo")
 def lisp_modulo(val0, val1):
-    _check_nums(val0, val1)
+    if not (type(val0) in _FAST_NUMBERS and type(val1) in _FAST_NUMBERS):
+        _check_nums(val0, val1)
     try:
         return val0 % val1
     except ZeroDivisionError as err:
@@ -254,7 +658,8 @@ def lisp_modulo(val0, val1):
 
 @builtin("remainder")
 def lisp_remainder(val0, val1):
-    _check_nums(val0, val1)
+    if not (type(val0) in _FAST_NUMBERS and type(val1) in _FAST_NUMBERS):
+        _check_nums(val0, val1)
     try:
         result = val0 % val1
     except ZeroDivisionError as err:
@@ -268,8 +673,13 @@ def number_fn(module, name, fallback=None):
     MODULE.FN."""
     py_fn = getattr(module, name) if fallback is None else getattr(module, name, fallback)
     def lisp_fn(*vals):
-        _check_nums(*vals)
-        return py_fn(*vals)
+        if _check_operands(*vals):
+            return _elementwise(name, py_fn, vals)
+        try:
+            return py_fn(*vals)
+        except (ArithmeticError, ValueError) as err:
+            raise lispError(err)
+    lisp_fn.arity = (1, 2) if name == 'log' else function_arity(py_fn)
     return lisp_fn
 
 # Add number functions in the math module as built-in procedures in lisp
@@ -284,24 +694,37 @@ def _numcomp(op, x, y):
     _check_nums(x, y)
     return op(x, y)
 
+# The comparisons compare ints and floats directly, and check other operands
+# with _numcomp.
+
 @builtin("=")
 def lisp_eq(x, y):
+    if type(x) in _FAST_NUMBERS and type(y) in _FAST_NUMBERS:
+        return x == y
     return _numcomp(operator.eq, x, y)
 
 @builtin("<")
 def lisp_lt(x, y):
+    if type(x) in _FAST_NUMBERS and type(y) in _FAST_NUMBERS:
+        return x < y
     return _numcomp(operator.lt, x, y)
 
 @builtin(">")
 def lisp_gt(x, y):
+    if type(x) in _FAST_NUMBERS and type(y) in _FAST_NUMBERS:
+        return x > y
     return _numcomp(operator.gt, x, y)
 
 @builtin("<=")
 def lisp_le(x, y):
+    if type(x) in _FAST_NUMBERS and type(y) in _FAST_NUMBERS:
+        return x <= y
     return _numcomp(operator.le, x, y)
 
 @builtin(">=")
 def lisp_ge(x, y):
+    if type(x) in _FAST_NUMBERS and type(y) in _FAST_NUMBERS:
+        return x >= y
     return _numcomp(operator.ge, x, y)
 
 @builtin("even?")
@@ -319,6 +742,199 @@ def lisp_zerop(x):
     _check_nums(x)
     return x == 0
 
+##
+## Numeric arrays
+##
+
+@builtin("array?")
+def lisp_arrayp(x):
+    return is_array(x)
+
+def _array_number(x):
+    """Return X, a float computed from an array, as a lisp number."""
+    return int(x) if x.is_integer() else x
+
+@builtin("array")
+def lisp_array(*vals):
+    _check_nums(*vals)
+    return make_array(vals)
+
+@builtin("make-array")
+def lisp_make_array(k, fill=0):
+    check_type(k, _is_size, 0, 'make-array')
+    check_type(fill, lisp_numberp, 1, 'make-array')
+    return make_array([fill] * int(k))
+
+@builtin("list->array")
+def lisp_list_to_array(s):
+    check_type(s, lisp_listp, 0, 'list->array')
+    vals = []
+    while s is not nil:
+        vals.append(s.first)
+        s = s.second
+    _check_nums(*vals)
+    return make_array(vals)
+
+@builtin("array->list")
+def lisp_array_to_list(a):
+    check_type(a, lisp_arrayp, 0, 'array->list')
+    return lisp_list(*to_list(a))
+
+@builtin("array-length")
+def lisp_array_length(a):
+    check_type(a, lisp_arrayp, 0, 'array-length')
+    return len(a)
+
+@builtin("array-ref")
+def lisp_array_ref(a, k):
+    check_type(a, lisp_arrayp, 0, 'array-ref')
+    return float(a[_check_index(a, k, 'array-ref', lisp_arrayp)])
+
+@builtin("array-set!")
+def lisp_array_set(a, k, val):
+    check_type(val, lisp_numberp, 2, 'array-set!')
+    a[_check_index(a, k, 'array-set!', lisp_arrayp)] = val
+    mutated()
+
+@builtin("array-slice")
+def lisp_array_slice(a, start, end=None, step=1):
+    check_type(a, lisp_arrayp, 0, 'array-slice')
+    for i, v in enumerate((start, end, step)):
+        if v is not None:
+            check_type(v, lisp_integerp, i + 1, 'array-slice')
+    if step == 0:
+        raise lispError('array-slice step cannot be 0')
+    return slice_array(a, start, end, step)
+
+@builtin("sum")
+def lisp_sum(a):
+    check_type(a, lisp_arrayp, 0, 'sum')
+    return _array_number(total(a))
+
+@builtin("product")
+def lisp_product(a):
+    check_type(a, lisp_arrayp, 0, 'product')
+    return _array_number(product(a))
+
+@builtin("array-min")
+def lisp_array_min(a):
+    check_type(a, lambda x: lisp_arrayp(x) and len(x) > 0, 0, 'array-min')
+    return _array_number(minimum(a))
+
+@builtin("array-max")
+def lisp_array_max(a):
+    check_type(a, lambda x: lisp_arrayp(x) and len(x) > 0, 0, 'array-max')
+    return _array_number(maximum(a))
+
+@builtin("mean")
+def lisp_mean(a):
+    check_type(a, lambda x: lisp_arrayp(x) and len(x) > 0, 0, 'mean')
+    return _array_number(total(a) / len(a))
+
+@builtin("dot")
+def lisp_dot(a, b):
+    check_type(a, lisp_arrayp, 0, 'dot')
+    check_type(b, lisp_arrayp, 1, 'dot')
+    try:
+        return _array_number(dot(a, b))
+    except ValueError as err:
+        raise lispError(err)
+
+##
+## Persistent maps and vectors
+##
+
+@builtin("pmap?")
+def lisp_pmapp(x):
+    return isinstance(x, PersistentMap)
+
+@builtin("pmap")
+def lisp_pmap(*vals):
+    if len(vals) % 2:
+        raise lispError('pmap requires an even number of arguments')
+    m = PersistentMap(lisp_hash, lisp_equalp)
+    for i in range(0, len(vals), 2):
+        m = m.assoc(vals[i], vals[i + 1])
+    return m
+
+@builtin("pmap-assoc")
+def lisp_pmap_assoc(m, key, value):
+    check_type(m, lisp_pmapp, 0, 'pmap-assoc')
+    return m.assoc(key, value)
+
+@builtin("pmap-dissoc")
+def lisp_pmap_dissoc(m, key):
+    check_type(m, lisp_pmapp, 0, 'pmap-dissoc')
+    return m.dissoc(key)
+
+@builtin("pmap-get")
+def lisp_pmap_get(m, key, default=_no_default):
+    check_type(m, lisp_pmapp, 0, 'pmap-get')
+    value = m.get(key, default)
+    if value is _no_default:
+        raise lispError('key not found: {0}'.format(repl_str(key)))
+    return value
+
+@builtin("pmap-contains?")
+def lisp_pmap_containsp(m, key):
+    check_type(m, lisp_pmapp, 0, 'pmap-contains?')
+    return key in m
+
+@builtin("pmap-count")
+def lisp_pmap_count(m):
+    check_type(m, lisp_pmapp, 0, 'pmap-count')
+    return len(m)
+
+@builtin("pmap-keys")
+def lisp_pmap_keys(m):
+    check_type(m, lisp_pmapp, 0, 'pmap-keys')
+    return lisp_list(*m)
+
+@builtin("pvec?")
+def lisp_pvecp(x):
+    return isinstance(x, PersistentVector)
+
+@builtin("pvec")
+def lisp_pvec(*vals):
+    return PersistentVector.from_iterable(vals)
+
+@builtin("list->pvec")
+def lisp_list_to_pvec(s):
+    check_type(s, lisp_listp, 0, 'list->pvec')
+    return PersistentVector.from_iterable(lisp_list_to_vector(s))
+
+@builtin("pvec->list")
+def lisp_pvec_to_list(v):
+    check_type(v, lisp_pvecp, 0, 'pvec->list')
+    return lisp_list(*v)
+
+@builtin("pvec-conj")
+def lisp_pvec_conj(v, *vals):
+    check_type(v, lisp_pvecp, 0, 'pvec-conj')
+    for val in vals:
+        v = v.conj(val)
+    return v
+
+@builtin("pvec-nth")
+def lisp_pvec_nth(v, k):
+    k = _check_index(v, k, 'pvec-nth', lisp_pvecp)
+    return v.nth(k)
+
+@builtin("pvec-assoc")
+def lisp_pvec_assoc(v, k, val):
+    k = _check_index(v, k, 'pvec-assoc', lisp_pvecp)
+    return v.assoc(k, val)
+
+@builtin("pvec-pop")
+def lisp_pvec_pop(v):
+    check_type(v, lambda x: lisp_pvecp(x) and len(x) > 0, 0, 'pvec-pop')
+    return v.pop()
+
+@builtin("pvec-count")
+def lisp_pvec_count(v):
+    check_type(v, lisp_pvecp, 0, 'pvec-count')
+    return len(v)
+
 ##
 ## Other operations
 ##
@@ -331,8 +947,9 @@ def lisp_atomp(x):
 @builtin("display")
 def lisp_display(val):
     if lisp_stringp(val):
-        val = eval(val)
-    print(repl_str(val), end="")
+        print(val.text, end="")
+    else:
+        print(repl_str(val), end="")
 
 @builtin("print")
 def lisp_print(val):
@@ -364,6 +981,26 @@ def lisp_print_return(val1, val2):
 ## Turtle graphics (non-standard)
 ##
 
+class _LazyModule(object):
+    """A stand-in for the module NAME, which imports it when one of its
+    attributes is first used, so that only programs that draw import turtle
+    and tkinter."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        try:
+            module = importlib.import_module(self.name)
+        except ImportError as exc:
+            raise lispError('could not import the {0} module: {1}'.format(
+                self.name, exc))
+        globals()[self.name] = module
+        return getattr(module, attr)
+
+turtle = _LazyModule('turtle')
+tkinter = _LazyModule('tkinter')
+
 _turtle_screen_on = False
 
 def turtle_screen_on():
@@ -372,9 +1009,9 @@ def turtle_screen_on():
 def _tlisp_prep():
     global _turtle_screen_on
     if not _turtle_screen_on:
-        _turtle_screen_on = True
         turtle.title("lisp Turtles")
         turtle.mode('logo')
+        _turtle_screen_on = True
 
 @builtin("forward", "fd")
 def tlisp_forward(n):
@@ -469,7 +1106,7 @@ def tlisp_color(c):
     hexadecimal red, green, and blue values."""
     _tlisp_prep()
     check_type(c, lisp_stringp, 0, "color")
-    turtle.color(eval(c))
+    turtle.color(c.text)
 
 @builtin("rgb")
 def tlisp_rgb(red, green, blue):
@@ -479,7 +1116,7 @@ def tlisp_rgb(red, green, blue):
         if x < 0 or x > 1:
             raise lispError("Illegal color intensity in " + repl_str(colors))
     scaled = tuple(int(x*255) for x in colors)
-    return '"#%02x%02x%02x"' % scaled
+    return String('#%02x%02x%02x' % scaled)
 
 @builtin("begin_fill")
 def tlisp_begin_fill():
@@ -497,7 +1134,7 @@ def tlisp_end_fill():
 def tlisp_bgcolor(c):
     _tlisp_prep()
     check_type(c, lisp_stringp, 0, "bgcolor")
-    turtle.bgcolor(eval(c))
+    turtle.bgcolor(c.text)
 
 @builtin("exitonclick")
 def tlisp_exitonclick():
@@ -521,7 +1158,7 @@ def tlisp_speed(s):
 def tlisp_pixel(x, y, c):
     """Draw a filled box of pixels (default 1 pixel) at (X, Y) in color C."""
     check_type(c, lisp_stringp, 0, "pixel")
-    color = eval(c)
+    color = c.text
     canvas = turtle.getcanvas()
     w, h = canvas.winfo_width(), canvas.winfo_height()
     if not hasattr(tlisp_pixel, 'image'):
@@ -0,0 +1,200 @@
+"""Cache files of the expressions read from lisp source files.
+
+Loading a file whose cache entry is valid evaluates the expressions stored in
+the entry instead of reading the source again. Entries are kept in a
+__lispcache__ directory beside their sources, much as Python keeps compiled
+modules in __pycache__, when that directory is writable. Each begins with a
+header that holds the format version, the Python version, a SHA-256 hash of
+the sources of the reader, and a SHA-256 hash of the source file. An entry
+whose header does not match is stale and is ignored, so a change to the
+reader makes every entry stale. Run the interpreter with --no-cache to load
+files without reading or writing entries.
+
+The expressions follow the header one at a time in marshal format, encoded
+as follows:
+
+  * A list as a tuple of its elements, and nil as the empty tuple
+  * A vector as a list of its elements
+  * A symbol as a str, and a string as its text in UTF-8 bytes
+  * A number or boolean as itself
+"""
+
+from __future__ import print_function  # Python 2 compatibility
+
+import hashlib
+import marshal
+import os
+import sys
+
+from lisp_reader import Pair, Vector, nil, pair_from_items
+from lisp_tokens import Symbol, String
+
+FORMAT = 1  # The version of the format of cache files
+MAGIC = 'lisp-cache {0} python {1}.{2} marshal {3}\n'.format(
+    FORMAT, sys.version_info[0], sys.version_info[1], marshal.version).encode()
+CACHE_DIR = '__lispcache__'
+
+# The modules whose sources determine the expressions read from a file
+READER_MODULES = ('buffer', 'lisp_cache', 'lisp_reader', 'lisp_tokens')
+_reader_digest = None  # The hash of their sources, once it is needed
+
+def cache_path(filename):
+    """Return the name of the cache file for the source file FILENAME.
+
+    >>> cache_path(os.path.join('lib', 'util.scm'))
+    'lib/__lispcache__/util.scm.lspc'
+    """
+    directory, name = os.path.split(filename)
+    return os.path.join(directory, CACHE_DIR, name + '.lspc')
+
+def reader_digest():
+    """Return the SHA-256 hash of the sources of READER_MODULES."""
+    global _reader_digest
+    if _reader_digest is None:
+        digest = hashlib.sha256()
+        for name in READER_MODULES:
+            with open(sys.modules[name].__file__, 'rb') as source:
+                digest.update(source.read())
+        _reader_digest = digest.digest()
+    return _reader_digest
+
+def source_key(infile):
+    """Return the header of the cache entry for the source file INFILE, an
+    open text file, which is left at its start."""
+    digest = hashlib.sha256()
+    for block in iter(lambda: infile.buffer.read(1 << 16), b''):
+        digest.update(block)
+    infile.seek(0)
+    return MAGIC + reader_digest() + digest.digest()
+
+def encode(expr):
+    """Return the expression EXPR in the form in which it is marshalled.
+    Raises ValueError if EXPR is not made of values that the reader returns.
+
+    >>> from lisp_reader import read_line
+    >>> encode(read_line('(define (f) (list \\'s "t" #(1 2.5) nil #t))'))
+    ('define', ('f',), ('list', ('quote', 's'), b't', [1, 2.5], (), True))
+    """
+    kind = type(expr)
+    if kind is Symbol:
+        return str(expr)
+    elif kind is Pair or expr is nil:
+        items = []
+        while type(expr) is Pair:
+            items.append(encode(expr.first))
+            expr = expr.second
+        if expr is not nil:
+            raise ValueError('cannot cache a list that ends in {0}'.format(
+                expr))
+        return tuple(items)
+    elif kind is Vector:
+        return [encode(item) for item in expr]
+    elif kind is String:
+        return expr.text.encode('utf-8', 'surrogatepass')
+    elif kind in (bool, int, float):
+        return expr
+    raise ValueError('cannot cache {0}'.format(expr))
+
+def decode(data):
+    """Return the expression that encode(expression) returned as DATA.
+
+    >>> decode(('list', ('quote', 's'), b't', [1, 2.5], (), True))
+    Pair('list', Pair(Pair('quote', Pair('s', nil)), Pair(String('t'), \
+Pair(Vector([1, 2.5]), Pair(nil, Pair(True, nil))))))
+    """
+    kind = type(data)
+    if kind is str:
+        return Symbol(data)
+    elif kind is tuple:
+        return pair_from_items([decode(item) for item in data], nil)
+    elif kind is list:
+        return Vector([decode(item) for item in data])
+    elif kind is bytes:
+        return String(data.decode('utf-8', 'surrogatepass'))
+    return data
+
+def read_cache(filename, key):
+    """Return an iterator over the expressions in the cache entry for the
+    source file FILENAME, or None if there is no entry with header KEY."""
+    try:
+        cache = open(cache_path(filename), 'rb')
+    except OSError:
+        return None
+    if cache.read(len(key)) != key:
+        cache.close()
+        return None
+    def expressions():
+        with cache:
+            while True:
+                try:
+                    data = marshal.load(cache)
+                except EOFError:
+                    return
+                yield decode(data)
+    return expressions()
+
+class CacheWriter(object):
+    """A CacheWriter writes the cache entry with header KEY for the source
+    file FILENAME, one expression at a time. The entry replaces any old one
+    only when it is committed, and not at all if an expression could not be
+    encoded or the entry could not be written. Nothing is written unless the
+    directory of the entry, or that of FILENAME if there is none, is
+    writable."""
+
+    def __init__(self, filename, key):
+        self.path = cache_path(filename)
+        self.temp = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        self.file = None
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            directory = os.path.dirname(directory) or os.curdir
+        if not os.access(directory, os.W_OK):
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.file = open(self.temp, 'wb')
+            self.file.write(key)
+        except OSError:
+            self.file = None
+
+    def add(self, expr):
+        """Write the expression EXPR to the entry."""
+        if self.file is not None:
+            try:
+                marshal.dump(encode(expr), self.file)
+            except (ValueError, RecursionError, OSError):
+                self.discard()
+
+    def commit(self):
+        """Finish the entry and replace the old one with it."""
+        if self.file is not None:
+            try:
+                self.file.close()
+                os.replace(self.temp, self.path)
+            except OSError:
+                self.discard()
+            self.file = None
+
+    def discard(self):
+        """Abandon the entry, leaving any old one in place."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            try:
+                os.remove(self.temp)
+            except OSError:
+                pass
+
+class CachedForms(object):
+    """The expressions of a file, read from its cache, in place of the Buffer
+    that read_eval_print_loop reads them from with read_form."""
+    more_on_line = True
+
+    def __init__(self, expressions):
+        self.expressions = expressions
+
+def read_form(src):
+    """Return the next expression of SRC, a CachedForms."""
+    for expr in src.expressions:
+        return expr
+    raise EOFError
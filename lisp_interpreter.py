@@ -1,9 +1,24 @@
 """A lisp interpreter and its read-eval-print loop."""
 from __future__ import print_function  # Python 2 compatibility
 
+if __name__ == '__main__':
+    # Run in the lisp_interpreter module, which lisp_vm imports, rather than
+    # in a second copy of it named __main__.
+    import sys
+    import lisp_interpreter
+    lisp_interpreter.run(*sys.argv[1:])
+    sys.exit()
+
+import io
+import operator
+import pickle
+import types
+import weakref
+
 from lisp_builtins import *
 from lisp_reader import *
 from ucb import main, trace
+import lisp_cache
 
 
 # Eval/Apply 
@@ -34,14 +49,17 @@ def lisp_eval(expr, env, _=None): # Optional third argument is ignored
         if isinstance(procedure, MacroProcedure):
             return lisp_eval(procedure.apply_macro(rest, env), env)
         else:
-            def helper(expr, env =env):
-                return lisp_eval(expr, env)
-            return lisp_apply(procedure, rest.map(helper), env)
+            args = []
+            while rest is not nil:
+                args.append(lisp_eval(rest.first, env))
+                rest = rest.second
+            return lisp_call(procedure, args, env)
         
 
 def self_evaluating(expr):
     """Return whether EXPR evaluates to itself."""
-    return (lisp_atomp(expr) and not lisp_symbolp(expr)) or expr is None
+    return ((lisp_atomp(expr) and not lisp_symbolp(expr)) or expr is None
+            or lisp_vectorp(expr))
 
 def lisp_apply(procedure, args, env):
     """Apply lisp PROCEDURE to argument values ARGS (a lisp list) in
@@ -51,28 +69,96 @@ def lisp_apply(procedure, args, env):
         return procedure.apply(args, env)
     else:
         new_env = procedure.make_call_frame(args, env)
-        return eval_all(procedure.body, new_env)
+        return execute(procedure.analyzed, new_env)
+
+def lisp_call(procedure, args, env):
+    """Apply lisp PROCEDURE to ARGS, a Python list of argument values that
+    the callee may keep, in environment ENV. Unlike lisp_apply, no lisp
+    list of the arguments is built."""
+    check_procedure(procedure)
+    if isinstance(procedure, BuiltinProcedure):
+        return procedure.call(args, env)
+    else:
+        return execute(procedure.analyzed, procedure.make_frame(args, env))
 
 def eval_all(expressions, env):
     """Evaluate each expression in the lisp list EXPRESSIONS in
     environment ENV and return the value of the last."""
     
-    if expressions == nil:
+    if expressions is nil:
         return None
-    if len(expressions) == 1:
-        return lisp_eval(expressions.first, env, True)
-    lisp_eval(expressions.first, env)
-    return eval_all(expressions.second, env)
+    while expressions.second is not nil:
+        lisp_eval(expressions.first, env)
+        expressions = expressions.second
+    return lisp_eval(expressions.first, env, True)
 
 # Environments 
 
+class InlineCache(object):
+    """An inline cache remembers the VALUE of SYMBOL in the global FRAME for
+    one reference to it in analyzed code. The value is current while
+    VERSION matches the version of FRAME, which define increments. HITS and
+    MISSES count the lookups that used the cached value and the lookups
+    that had to find it again."""
+    __slots__ = ('frame', 'symbol', 'version', 'value', 'hits', 'misses',
+                 '__weakref__')
+
+    def __init__(self, frame, symbol):
+        self.frame = frame
+        self.symbol = symbol
+        self.version = -1
+        self.value = None
+        self.hits = self.misses = 0
+        INLINE_CACHES.add(self)
+
+    def __repr__(self):
+        return 'InlineCache({0}, {1})'.format(repr(self.frame), repr(self.symbol))
+
+    def refresh(self, env):
+        """Return the value of SYMBOL in ENV, the current frame, and cache it
+        unless SYMBOL may be bound in a local frame."""
+        self.misses += 1
+        frame, symbol = self.frame, self.symbol
+        if symbol in frame.shadowed:
+            return env.lookup(symbol)
+        self.value = frame.lookup(symbol)
+        self.version = frame.version
+        return self.value
+
+INLINE_CACHES = weakref.WeakSet()  # Every InlineCache still in use
+
+def inline_cache_stats():
+    """Return the total hits and misses of all inline caches in use.
+
+    >>> import gc; _ = gc.collect()  # Discard the caches of unused code
+    >>> env = create_global_frame()
+    >>> hits, misses = inline_cache_stats()
+    >>> lisp_eval(read_line('(define (f n) (if (= n 0) 0 (f (- n 1))))'), env)
+    'f'
+    >>> lisp_eval(read_line('(f 10)'), env)
+    0
+    >>> [a - b for a, b in zip(inline_cache_stats(), (hits, misses))]
+    [28, 3]
+    """
+    hits = misses = 0
+    for cache in list(INLINE_CACHES):
+        hits, misses = hits + cache.hits, misses + cache.misses
+    return hits, misses
+
+UNASSIGNED = object()  # The contents of a slot that holds no value
+
 class Frame(object):
-    """An environment frame binds lisp symbols to lisp values."""
+    """An environment frame binds lisp symbols to lisp values. The global
+    frame is a Frame; the frames of calls and let forms are LocalFrames.
+    Its VERSION changes whenever a binding does."""
+    __slots__ = ('bindings', 'parent', 'version', 'shadowed')
 
     def __init__(self, parent):
         """An empty frame with parent frame PARENT (which may be None)."""
         self.bindings = {}
         self.parent = parent
+        self.version = 0
+        self.shadowed = {}
 
     def __repr__(self):
         if self.parent is None:
@@ -84,6 +170,7 @@ class Frame(object):
         """Define lisp SYMBOL to have VALUE."""
         
         self.bindings[symbol]=value
+        self.version += 1
 
     def lookup(self, symbol):
         """Return the value bound to SYMBOL. Errors if SYMBOL is not found."""
@@ -95,7 +182,33 @@ class Frame(object):
                 return self.parent.lookup(symbol)
             else:
                 raise lispError('unknown identifier: {0}'.format(symbol))
-        
+
+    def shadow(self, symbol):
+        """Note that SYMBOL has been bound in a local frame by a define that
+        analysis did not find. Analyzed references to SYMBOL that resolved to
+        SELF may no longer be correct, so their caches are invalidated, and
+        they look SYMBOL up by name until unshadow has been called as many
+        times as shadow."""
+        self.shadowed[symbol] = self.shadowed.get(symbol, 0) + 1
+        self.version += 1
+
+    def unshadow(self, symbol):
+        """Note that a local frame that shadowed SYMBOL is gone.
+
+        >>> env = create_global_frame()
+        >>> for line in ['(define x 1)', '(define k (let ((y 0)) '
+        ...              '(eval (quote (define x 2))) (lambda () x)))']:
+        ...     _ = lisp_eval(read_line(line), env)
+        >>> env.shadowed, lisp_eval(read_line('(k)'), env)
+        ({'x': 1}, 2)
+        >>> lisp_eval(read_line('(define k 0)'), env)
+        'k'
+        >>> env.shadowed, lisp_eval(read_line('x'), env)
+        ({}, 1)
+        """
+        count = self.shadowed.pop(symbol) - 1
+        if count:
+            self.shadowed[symbol] = count
 
     def make_child_frame(self, formals, vals):
         """Return a new local frame whose parent is SELF, in which the symbols
@@ -113,12 +226,72 @@ class Frame(object):
         if len(formals) != len(vals):
             raise lispError('Too many or too few vals are given.')
         
-        new_env = Frame(self)
-        for i in range(len(formals)):
-            new_env.define(formals.first, vals.first)
-            formals , vals = formals.second, vals.second
+        layout, values = {}, []
+        while formals is not nil:
+            layout[formals.first] = len(values)
+            values.append(vals.first)
+            formals, vals = formals.second, vals.second
+
+        return LocalFrame(layout, values, self)
+
+class Extras(dict):
+    """The EXTRAS of a LocalFrame. Only the frame refers to them, so they
+    are collected along with it, and unlike a dict they can be weakly
+    referenced, so the global frame can stop shadowing their symbols then."""
+    __slots__ = ('__weakref__',)
+
+class LocalFrame(object):
+    """A frame whose bindings are held in a list of slots. Its LAYOUT is a
+    dictionary from symbols to slot indices that is shared by every frame
+    of the same procedure, so analyzed code can address a binding by its
+    depth in the environment and its slot. A slot holds UNASSIGNED until
+    its symbol is defined. Symbols outside the layout that are defined in
+    the frame (e.g., by eval) are kept in a dictionary of EXTRAS."""
+    __slots__ = ('layout', 'values', 'parent', 'extras')
+
+    def __init__(self, layout, values, parent):
+        self.layout = layout
+        self.values = values
+        self.parent = parent
+        self.extras = None
+
+    def __repr__(self):
+        bindings = dict(self.extras or {})
+        for symbol, slot in self.layout.items():
+            if self.values[slot] is not UNASSIGNED:
+                bindings[symbol] = self.values[slot]
+        s = sorted(['{0}: {1}'.format(k, v) for k, v in bindings.items()])
+        return '<{{{0}}} -> {1}>'.format(', '.join(s), repr(self.parent))
 
-        return  new_env
+    def define(self, symbol, value):
+        """Define lisp SYMBOL to have VALUE."""
+        if symbol in self.layout:
+            self.values[self.layout[symbol]] = value
+            return
+        if self.extras is None:
+            self.extras = Extras()
+        if symbol not in self.extras:
+            frame = self.parent
+            while isinstance(frame, LocalFrame):
+                frame = frame.parent
+            frame.shadow(symbol)
+            weakref.finalize(self.extras, frame.unshadow, symbol)
+        self.extras[symbol] = value
+
+    def lookup(self, symbol):
+        """Return the value bound to SYMBOL. Errors if SYMBOL is not found."""
+        frame = self
+        while isinstance(frame, LocalFrame):
+            if symbol in frame.layout:
+                value = frame.values[frame.layout[symbol]]
+                if value is not UNASSIGNED:
+                    return value
+            elif frame.extras is not None and symbol in frame.extras:
+                return frame.extras[symbol]
+            frame = frame.parent
+        return frame.lookup(symbol)
+
+    make_child_frame = Frame.make_child_frame
 
 # Procedures 
 class Procedure(object):
@@ -128,12 +301,20 @@ def lisp_procedurep(x):
     return isinstance(x, Procedure)
 
 class BuiltinProcedure(Procedure):
-    """A lisp procedure defined as a Python function."""
+    """A lisp procedure defined as a Python function. If USE_ENV, the
+    function takes the environment of the call as an extra last argument.
+    The procedure accepts from MIN_ARGS to MAX_ARGS arguments (None for no
+    limit), as declared by the function (see function_arity)."""
 
     def __init__(self, fn, use_env=False, name='builtin'):
         self.name = name
         self.fn = fn
         self.use_env = use_env
+        least, greatest = function_arity(fn)
+        if use_env:
+            least = max(least - 1, 0)
+            greatest = None if greatest is None else greatest - 1
+        self.min_args, self.max_args = least, greatest
 
     def __str__(self):
         return '#[{0}]'.format(self.name)
@@ -154,31 +335,67 @@ class BuiltinProcedure(Procedure):
         while args is not nil:
             python_args.append(args.first)
             args = args.second
-       
+        return self.call(python_args, env)
+
+    def call(self, args, env):
+        """Apply SELF to ARGS in ENV, where ARGS is a Python list that may be
+        modified.
+
+        >>> car = create_global_frame().lookup('car')
+        >>> car.call([1, 2], None)
+        Traceback (most recent call last):
+        ...
+        lisp_reader.lispError: car requires 1 argument(s), but got 2
+        >>> create_global_frame().lookup('quotient').call([1, 0], None)
+        Traceback (most recent call last):
+        ...
+        lisp_reader.lispError: integer division or modulo by zero
+        """
+        n = len(args)
+        if n < self.min_args or self.max_args is not None and n > self.max_args:
+            raise lispError(self.arity_message(n))
         if self.use_env:
-            python_args.append(env)
-        try:
-            return self.fn(*python_args) 
-        except:
-            raise lispError
+            args.append(env)
+        return self.fn(*args)
+
+    def arity_message(self, n):
+        """Describe a call of SELF with the wrong number N of arguments."""
+        if self.max_args is None:
+            expected = 'at least {0}'.format(self.min_args)
+        elif self.min_args == self.max_args:
+            expected = self.min_args
+        else:
+            expected = '{0} to {1}'.format(self.min_args, self.max_args)
+        return '{0} requires {1} argument(s), but got {2}'.format(
+            self.name, expected, n)
 
 class LambdaProcedure(Procedure):
     """A procedure defined by a lambda expression or a define form."""
 
-    def __init__(self, formals, body, env):
+    def __init__(self, formals, body, env, layout=None, analyzed=None):
         """A procedure with formal parameter list FORMALS (a lisp list),
         whose body is the lisp list BODY, and whose parent environment
-        starts with Frame ENV."""
+        starts with Frame ENV. LAYOUT and ANALYZED are the frame layout and
+        analyzed form of BODY, which are computed here if not given."""
         self.formals = formals
         self.body = body
         self.env = env
+        if analyzed is None:
+            layout, analyzed = analyze_body(formals, body, env)
+        self.layout = layout
+        self.analyzed = analyzed
+        self.arity = len(formals) if isinstance(formals, Pair) else 0
 
     def make_call_frame(self, args, env):
         """Make a frame that binds my formal parameters to ARGS, a lisp list
         of values, for a lexically-scoped call evaluated in environment ENV."""
        
-        new_env = self.env.make_child_frame(self.formals, args)
-        return new_env
+        return make_slot_frame(self, args, self.env)
+
+    def make_frame(self, args, env):
+        """Make a frame like make_call_frame, but from ARGS, a Python list of
+        values that becomes the slots of the frame."""
+        return make_arg_frame(self, args, self.env)
 
     def __str__(self):
         return str(Pair('lambda', Pair(self.formals, self.body)))
@@ -195,12 +412,41 @@ class MacroProcedure(LambdaProcedure):
         """Apply this macro to the operand expressions."""
         return complete_apply(self, operands, env)
 
+def make_slot_frame(procedure, args, parent):
+    """Return a LocalFrame with parent PARENT for a call of PROCEDURE, a
+    LambdaProcedure or MuProcedure, on ARGS, a lisp list of values."""
+    values = []
+    while args is not nil:
+        values.append(args.first)
+        args = args.second
+    return make_arg_frame(procedure, values, parent)
+
+def make_arg_frame(procedure, values, parent):
+    """Return a LocalFrame with parent PARENT for a call of PROCEDURE on
+    VALUES, a Python list that becomes the slots of the frame."""
+    if len(values) != procedure.arity:
+        raise lispError('Too many or too few vals are given.')
+    if len(procedure.layout) != procedure.arity:
+        values.extend([UNASSIGNED] * (len(procedure.layout) - procedure.arity))
+    return LocalFrame(procedure.layout, values, parent)
+
+def eval_procedure(evaluate):
+    """Return the eval procedure, which evaluates an expression with EVALUATE
+    in the frame given as an optional second argument, or else in the
+    environment of the call."""
+    def lisp_eval_in(expr, env, _=None):
+        check_type(env, lambda x: isinstance(x, (Frame, LocalFrame)), 1,
+                   'eval')
+        return evaluate(expr, env)
+    return BuiltinProcedure(lisp_eval_in, True, 'eval')
+
 def add_builtins(frame, funcs_and_names):
     """Enter bindings in FUNCS_AND_NAMES into FRAME, an environment frame,
     as built-in procedures. Each item in FUNCS_AND_NAMES has the form
     (NAME, PYTHON-FUNCTION, INTERNAL-NAME)."""
     for name, fn, proc_name in funcs_and_names:
-        frame.define(name, BuiltinProcedure(fn, name=proc_name))
+        frame.define(name, BuiltinProcedure(fn, getattr(fn, 'use_env', False),
+                                            proc_name))
 
 # Special Forms 
 
@@ -216,13 +462,13 @@ def do_define_form(expressions, env):
     if lisp_symbolp(target):
         check_form(expressions, 2, 2)
         
-        Frame.define(env, expressions.first, lisp_eval(expressions.second.first, env))
+        env.define(expressions.first, lisp_eval(expressions.second.first, env))
         return expressions.first
     elif isinstance(target, Pair) and lisp_symbolp(target.first):
        
 
         lambd_a =do_lambda_form(Pair(target.second, expressions.second), env)
-        Frame.define(env, target.first, lambd_a)
+        env.define(target.first, lambd_a)
         return target.first
     else:
         bad_target = target.first if isinstance(target, Pair) else target
@@ -258,38 +504,28 @@ def do_if_form(expressions, env):
 def do_and_form(expressions, env):
     """Evaluate a (short-circuited) and form."""
     
-    if len(expressions) == 0:    # nil pair
+    if expressions is nil:
         return True
     
-    if len(expressions) == 1:     # If last Pair
-        evaled = lisp_eval(expressions.first, env, True)    
-    else:
+    while expressions.second is not nil:
         evaled = lisp_eval(expressions.first, env)
-    if lisp_falsep(evaled):
-        return evaled
-    
-    if len(expressions) == 1:
-        return evaled
-    else:
-        return do_and_form(expressions.second, env)
+        if lisp_falsep(evaled):
+            return evaled
+        expressions = expressions.second
+    return lisp_eval(expressions.first, env, True)    # If last Pair
 
 def do_or_form(expressions, env):
     """Evaluate a (short-circuited) or form."""
     
-    if len(expressions) ==0:
+    if expressions is nil:
         return False
 
-    if len(expressions) == 1:     # If last Pair
-        evaled = lisp_eval(expressions.first, env, True)    
-    else:
+    while expressions.second is not nil:
         evaled = lisp_eval(expressions.first, env)
-    if lisp_truep(evaled):
-        return evaled
-    
-    if len(expressions) == 1:
-        return evaled
-    else:
-        return do_or_form(expressions.second, env)
+        if lisp_truep(evaled):
+            return evaled
+        expressions = expressions.second
+    return lisp_eval(expressions.first, env, True)    # If last Pair
 
 def do_cond_form(expressions, env):
     """Evaluate a cond form."""
@@ -345,8 +581,7 @@ def do_define_macro(expressions, env):
 
         check_formals(formals)
         macro = MacroProcedure(formals, body, env)
-        Frame.define(env, target.first, macro)
-        print('DEBUG:', 'IS A MACRO?', isinstance(env.bindings[target.first], MacroProcedure))
+        env.define(target.first, macro)
         return target.first
     else:
          raise lispError
@@ -450,14 +685,23 @@ class MuProcedure(Procedure):
                     ||     ||
     """
 
-    def __init__(self, formals, body):
+    def __init__(self, formals, body, layout=None, analyzed=None):
         """A procedure with formal parameter list FORMALS (a lisp list) and
         lisp list BODY as its definition."""
         self.formals = formals
         self.body = body
+        if analyzed is None:
+            layout, analyzed = analyze_body(formals, body, None, True)
+        self.layout = layout
+        self.analyzed = analyzed
+        self.arity = len(formals) if isinstance(formals, Pair) else 0
     
     def make_call_frame(self, args, env):
-        return Frame.make_child_frame(env, self.formals, args)
+        return make_slot_frame(self, args, env)
+
+    def make_frame(self, args, env):
+        return make_arg_frame(self, args, env)
+
     def __str__(self):
         return str(Pair('mu', Pair(self.formals, self.body)))
 
@@ -495,6 +739,8 @@ class Promise(object):
         return '#[promise ({0}forced)]'.format(
                 'not ' if self.expression is not None else '')
 
+CDR_TYPES.add(Promise)
+
 def do_delay_form(expressions, env):
     """Evaluates a delay form."""
     check_form(expressions, 1, 1)
@@ -509,6 +755,121 @@ def do_cons_stream_form(expressions, env):
 SPECIAL_FORMS['cons-stream'] = do_cons_stream_form
 SPECIAL_FORMS['delay'] = do_delay_form
 
+# Records 
+class Record(object):
+    """An instance of a record type. Each record type is a subclass whose
+    __slots__ hold its FIELDS, a tuple of symbols, in order."""
+    __slots__ = ()
+    fields = ()
+
+    def __str__(self):
+        values = [repl_str(getattr(self, slot)) for slot in self.__slots__]
+        return '#[' + ' '.join([type(self).__name__] + values) + ']'
+
+def record_type_names(expressions):
+    """Return the symbols defined by a define-record-type form whose cdr is
+    EXPRESSIONS: its constructor, predicate, accessors, and modifiers."""
+    check_form(expressions, 3)
+    constructor, specs = expressions.second.first, expressions.second.second
+    if isinstance(constructor, Pair):
+        constructor = constructor.first
+    names = [constructor, specs.first]
+    specs = specs.second
+    while specs is not nil:
+        check_form(specs.first, 2, 3)
+        procedures = specs.first.second
+        while procedures is not nil:
+            names.append(procedures.first)
+            procedures = procedures.second
+        specs = specs.second
+    for name in names:
+        if not lisp_symbolp(name):
+            raise lispError('non-symbol: {0}'.format(repl_str(name)))
+    return names
+
+def do_define_record_type(expressions, env):
+    """Evaluate a define-record-type form, which defines a new record type
+    with a constructor, a predicate, and an accessor and optional modifier
+    for each field.
+
+    >>> env = create_global_frame()
+    >>> lisp_eval(read_line('''(define-record-type point (make-point x y)
+    ...     point? (x point-x set-point-x!) (y point-y))'''), env)
+    'point'
+    >>> lisp_eval(read_line('(point-y (make-point 1 2))'), env)
+    2
+    """
+    names = record_type_names(expressions)
+    type_name, constructor = expressions.first, expressions.second.first
+    if not lisp_symbolp(type_name):
+        raise lispError('non-symbol: {0}'.format(repl_str(type_name)))
+    fields, specs = [], expressions.second.second.second
+    while specs is not nil:
+        fields.append(specs.first.first)
+        specs = specs.second
+    if len(set(fields)) != len(fields):
+        raise lispError('duplicate field in {0}'.format(type_name))
+    slots = tuple('_{0}'.format(i) for i in range(len(fields)))
+    slot_of = dict(zip(fields, slots))
+    cls = type(str(type_name), (Record,), {'__slots__': slots,
+                                          'fields': tuple(fields)})
+
+    if isinstance(constructor, Pair):
+        arguments, params = [], constructor.second
+        while isinstance(params, Pair):
+            if params.first not in slot_of:
+                raise lispError('{0} is not a field of {1}'.format(
+                    repl_str(params.first), type_name))
+            arguments.append(slot_of[params.first])
+            params = params.second
+    else:
+        arguments = slots
+    new = cls.__new__
+    def construct(*args):
+        if len(args) != len(arguments):
+            raise lispError('{0} requires {1} argument(s), but got {2}'.format(
+                names[0], len(arguments), len(args)))
+        record = new(cls)
+        for slot in slots:
+            setattr(record, slot, None)
+        for slot, value in zip(arguments, args):
+            setattr(record, slot, value)
+        return record
+    env.define(names[0], BuiltinProcedure(construct, name=names[0]))
+
+    def is_record(x):
+        return type(x) is cls
+    env.define(names[1], BuiltinProcedure(is_record, name=names[1]))
+
+    specs = expressions.second.second.second
+    while specs is not nil:
+        field, procedures = specs.first.first, specs.first.second
+        env.define(procedures.first,
+                   record_accessor(is_record, slot_of[field], procedures.first))
+        if procedures.second is not nil:
+            env.define(procedures.second.first,
+                       record_modifier(is_record, slot_of[field],
+                                       procedures.second.first))
+        specs = specs.second
+    return type_name
+
+def record_accessor(is_record, slot, name):
+    """Return a procedure NAME that returns the SLOT of a record."""
+    get = operator.attrgetter(slot)
+    def accessor(record):
+        check_type(record, is_record, 0, name)
+        return get(record)
+    return BuiltinProcedure(accessor, name=name)
+
+def record_modifier(is_record, slot, name):
+    """Return a procedure NAME that sets the SLOT of a record."""
+    def modifier(record, value):
+        check_type(record, is_record, 0, name)
+        setattr(record, slot, value)
+    return BuiltinProcedure(modifier, name=name)
+
+SPECIAL_FORMS['define-record-type'] = do_define_record_type
+
 # Tail Recursion 
 class Thunk(object):
     """An expression EXPR to be evaluated in environment ENV."""
@@ -546,51 +907,917 @@ def optimize_tail_calls(original_lisp_eval):
 lisp_eval = optimize_tail_calls(lisp_eval)
 
 
+# Analysis
+# Each analyze_xxx function takes an expression and returns its analyzed form:
+# a Python function of one argument, an environment, that evaluates the
+# expression there. The syntax of an expression is examined once, when it is
+# analyzed, rather than every time it is evaluated. Errors in the syntax of a
+# form are raised when that form is evaluated, just as they are by lisp_eval.
+#
+# Analysis also resolves each symbol against the SCOPE of the expression: the
+# Scope of the innermost procedure or let body that contains it. A symbol
+# bound in a local frame is read from its slot at a known depth, and one
+# bound in the global frame is read from an InlineCache.
+
+class Scope(object):
+    """The frame layout of a procedure or let body under analysis. PARENT is
+    the Scope of the enclosing body, or else the Frame in which the
+    outermost procedure is created (None if it is not known). The frames
+    of a DYNAMIC scope (for a mu) have no fixed parent."""
+    def __init__(self, layout, parent, dynamic=False):
+        self.layout = layout
+        self.parent = parent
+        self.dynamic = dynamic
+
+class TailCall(object):
+    """A call of PROCEDURE on ARGS (a Python list) in environment ENV that
+    was made from a tail position in analyzed code and has not yet been
+    applied."""
+    __slots__ = ('procedure', 'args', 'env')
+
+    def __init__(self, procedure, args, env):
+        self.procedure = procedure
+        self.args = args
+        self.env = env
+
+def execute(analyzed, env):
+    """Evaluate the ANALYZED body of a procedure in environment ENV. Calls in
+    tail position are completed here, so they do not grow the Python stack."""
+    result = analyzed(env)
+    while isinstance(result, TailCall):
+        procedure, args, env = result.procedure, result.args, result.env
+        if isinstance(procedure, BuiltinProcedure):
+            return procedure.call(args, env)
+        result = procedure.analyzed(procedure.make_frame(args, env))
+    return result
+
+def analyze(expr, scope, tail=False):
+    """Return the analyzed form of lisp expression EXPR in SCOPE. If TAIL, a
+    call in tail position is returned as a TailCall rather than applied.
+
+    >>> env = create_global_frame()
+    >>> analyze(read_line('(+ 2 2)'), env)(env)
+    4
+    """
+    if lisp_symbolp(expr):
+        return analyze_symbol(expr, scope)
+    elif self_evaluating(expr):
+        return lambda env: expr
+
+    if not lisp_listp(expr):
+        return analyze_error(
+            lispError('malformed list: {0}'.format(repl_str(expr))))
+    first, rest = expr.first, expr.second
+    if lisp_symbolp(first) and first in SPECIAL_FORMS:
+        if first not in ANALYZERS:
+            return analyze_special_form(SPECIAL_FORMS[first], rest)
+        try:
+            return ANALYZERS[first](rest, scope, tail)
+        except lispError as err:
+            return analyze_error(err)
+    else:
+        return analyze_combination(first, rest, scope, tail)
+
+def analyze_body(formals, body, parent, dynamic=False):
+    """Analyze BODY, the body of a procedure with FORMALS whose scope has
+    parent PARENT. Return the layout of its frames and its analyzed form."""
+    layout = body_layout(formals, body)
+    scope = Scope(layout, parent, dynamic)
+    return layout, analyze_sequence(body, scope, True)
+
+def body_layout(formals, body):
+    """Return the layout of the frames of a procedure with FORMALS and BODY:
+    a slot for each formal parameter, then one for each symbol that BODY
+    defines."""
+    layout = {}
+    while isinstance(formals, Pair):
+        layout[formals.first] = len(layout)
+        formals = formals.second
+    for symbol in scan_defines(body):
+        if symbol not in layout:
+            layout[symbol] = len(layout)
+    return layout
+
+def scan_defines(expressions, symbols=None):
+    """Return a list of the symbols defined in the frame in which the lisp
+    list EXPRESSIONS is evaluated, by define and define-macro forms that
+    are not within a quoted or nested procedure or let body."""
+    if symbols is None:
+        symbols = []
+    while isinstance(expressions, Pair):
+        expr, expressions = expressions.first, expressions.second
+        if not isinstance(expr, Pair) or not lisp_listp(expr):
+            continue
+        first, rest = expr.first, expr.second
+        if not (lisp_symbolp(first) and first in SPECIAL_FORMS):
+            scan_defines(expr, symbols)
+        elif first in ('define', 'define-macro') and rest is not nil:
+            target = rest.first
+            if isinstance(target, Pair):
+                target = target.first
+            else:
+                scan_defines(rest.second, symbols)
+            if lisp_symbolp(target) and target not in symbols:
+                symbols.append(target)
+        elif first == 'define-record-type':
+            try:
+                names = record_type_names(rest)
+            except lispError:
+                continue  # The error is raised when the form is evaluated
+            symbols.extend(name for name in names if name not in symbols)
+        elif first in ('and', 'begin', 'if', 'or'):
+            scan_defines(rest, symbols)
+        elif first == 'cond':
+            while isinstance(rest, Pair):
+                scan_defines(rest.first, symbols)
+                rest = rest.second
+        elif first == 'let' and rest is not nil:
+            bindings = rest.first
+            while isinstance(bindings, Pair):
+                if isinstance(bindings.first, Pair):
+                    scan_defines(bindings.first.second, symbols)
+                bindings = bindings.second
+    return symbols
+
+def analyze_error(err):
+    """Analyze a form that raises a lispError like ERR when evaluated."""
+    def raise_error(env):
+        raise type(err)(*err.args)
+    return raise_error
+
+def resolve(symbol, scope):
+    """Return where a reference to SYMBOL in SCOPE finds its value, as one of
+        ('slot', DEPTH, SLOT): in SLOT of the frame DEPTH frames up,
+        ('global', FRAME, None): in the global FRAME, or
+        ('dynamic', DEPTH, None): by name, from the parent of the frame
+                                  DEPTH frames up."""
+    depth = 0
+    while isinstance(scope, Scope):
+        if symbol in scope.layout:
+            return 'slot', depth, scope.layout[symbol]
+        if scope.dynamic:
+            return 'dynamic', depth, None
+        scope, depth = scope.parent, depth + 1
+    while isinstance(scope, LocalFrame):
+        if symbol in scope.layout:
+            return 'slot', depth, scope.layout[symbol]
+        scope, depth = scope.parent, depth + 1
+    if isinstance(scope, Frame) and scope.parent is None:
+        return 'global', scope, None
+    return 'dynamic', depth - 1, None
+
+def analyze_symbol(symbol, scope):
+    """Analyze a reference to SYMBOL in SCOPE."""
+    kind, where, slot = resolve(symbol, scope)
+    if kind == 'slot':
+        return analyze_slot(symbol, where, slot)
+    elif kind == 'global':
+        return analyze_global(symbol, where)
+    else:
+        return analyze_dynamic(symbol, where)
+
+def analyze_slot(symbol, depth, slot):
+    """Analyze a reference to SYMBOL, which is held in SLOT of the frame
+    DEPTH frames up from the current one. If that slot is still UNASSIGNED,
+    SYMBOL is looked up in the enclosing frames."""
+    if depth == 0:
+        def lookup(env):
+            value = env.values[slot]
+            if value is UNASSIGNED:
+                return env.parent.lookup(symbol)
+            return value
+    elif depth == 1:
+        def lookup(env):
+            env = env.parent
+            value = env.values[slot]
+            if value is UNASSIGNED:
+                return env.parent.lookup(symbol)
+            return value
+    else:
+        def lookup(env):
+            for _ in range(depth):
+                env = env.parent
+            value = env.values[slot]
+            if value is UNASSIGNED:
+                return env.parent.lookup(symbol)
+            return value
+    return lookup
+
+def analyze_global(symbol, frame):
+    """Analyze a reference to SYMBOL, which is bound in the global FRAME
+    unless it has been shadowed."""
+    cache = InlineCache(frame, symbol)
+    def lookup(env):
+        if cache.version == frame.version:
+            cache.hits += 1
+            return cache.value
+        return cache.refresh(env)
+    return lookup
+
+def analyze_dynamic(symbol, depth):
+    """Analyze a reference to SYMBOL that is looked up by name, starting from
+    the parent of the frame DEPTH frames up from the current one."""
+    def lookup(env):
+        for _ in range(depth):
+            env = env.parent
+        return env.parent.lookup(symbol)
+    return lookup
+
+def analyze_sequence(expressions, scope, tail=False):
+    """Analyze the lisp list EXPRESSIONS, evaluated in order for the value
+    of the last."""
+    if expressions is nil:
+        return lambda env: None
+    procs = []
+    while expressions.second is not nil:
+        procs.append(analyze(expressions.first, scope))
+        expressions = expressions.second
+    last = analyze(expressions.first, scope, tail)
+    if not procs:
+        return last
+    def sequence(env):
+        for proc in procs:
+            proc(env)
+        return last(env)
+    return sequence
+
+def analyze_combination(operator, operands, scope, tail):
+    """Analyze a call of OPERATOR on the lisp list OPERANDS."""
+    operator_proc = analyze(operator, scope)
+    operand_procs = []
+    expressions = operands
+    while expressions is not nil:
+        operand_procs.append(analyze(expressions.first, scope))
+        expressions = expressions.second
+    expanded = [None, None]  # The last macro called here and its expansion
+    def combination(env):
+        procedure = operator_proc(env)
+        check_procedure(procedure)
+        if isinstance(procedure, MacroProcedure):
+            if expanded[0] is not procedure:
+                expansion = procedure.apply_macro(operands, env)
+                expanded[:] = procedure, analyze(expansion, scope, tail)
+            return expanded[1](env)
+        args = [proc(env) for proc in operand_procs]
+        if tail:
+            return TailCall(procedure, args, env)
+        return lisp_call(procedure, args, env)
+    return combination
+
+def analyze_special_form(do_form, expressions):
+    """Analyze a special form that has no analyzer of its own by evaluating
+    it with DO_FORM, its do_xxx_form function."""
+    def special_form(env):
+        result = do_form(expressions, env)
+        if isinstance(result, Thunk):
+            return lisp_eval(result.expr, result.env)
+        return result
+    return special_form
+
+def analyze_define_form(expressions, scope, tail):
+    """Analyze a define form."""
+    check_form(expressions, 2)
+    target = expressions.first
+    if lisp_symbolp(target):
+        check_form(expressions, 2, 2)
+        value_proc = analyze(expressions.second.first, scope)
+    elif isinstance(target, Pair) and lisp_symbolp(target.first):
+        value_proc = analyze_lambda_form(
+            Pair(target.second, expressions.second), scope, False)
+        target = target.first
+    else:
+        bad_target = target.first if isinstance(target, Pair) else target
+        raise lispError('non-symbol: {0}'.format(bad_target))
+    if isinstance(scope, Scope) and target in scope.layout:
+        slot = scope.layout[target]
+        def define(env):
+            env.values[slot] = value_proc(env)
+            return target
+    else:
+        def define(env):
+            env.define(target, value_proc(env))
+            return target
+    return define
+
+def analyze_quote_form(expressions, scope, tail):
+    """Analyze a quote form."""
+    check_form(expressions, 1, 1)
+    value = expressions.first
+    return lambda env: value
+
+def analyze_begin_form(expressions, scope, tail):
+    """Analyze a begin form."""
+    check_form(expressions, 1)
+    return analyze_sequence(expressions, scope, tail)
+
+def analyze_lambda_form(expressions, scope, tail):
+    """Analyze a lambda form."""
+    check_form(expressions, 2)
+    formals = expressions.first
+    check_formals(formals)
+    body = expressions.second
+    layout, analyzed = analyze_body(formals, body, scope)
+    def make_lambda(env):
+        return LambdaProcedure(formals, body, env, layout, analyzed)
+    return make_lambda
+
+def analyze_mu_form(expressions, scope, tail):
+    """Analyze a mu form."""
+    check_form(expressions, 2)
+    formals = expressions.first
+    check_formals(formals)
+    body = expressions.second
+    layout, analyzed = analyze_body(formals, body, scope, True)
+    def make_mu(env):
+        return MuProcedure(formals, body, layout, analyzed)
+    return make_mu
+
+def analyze_if_form(expressions, scope, tail):
+    """Analyze an if form."""
+    check_form(expressions, 2, 3)
+    predicate = analyze(expressions.first, scope)
+    consequent = analyze(expressions.second.first, scope, tail)
+    if len(expressions) == 3:
+        alternative = analyze(expressions.second.second.first, scope, tail)
+    else:
+        alternative = lambda env: None
+    def if_form(env):
+        if predicate(env) is not False:
+            return consequent(env)
+        return alternative(env)
+    return if_form
+
+def analyze_and_form(expressions, scope, tail):
+    """Analyze a (short-circuited) and form."""
+    if expressions is nil:
+        return lambda env: True
+    procs = []
+    while expressions.second is not nil:
+        procs.append(analyze(expressions.first, scope))
+        expressions = expressions.second
+    last = analyze(expressions.first, scope, tail)
+    def and_form(env):
+        for proc in procs:
+            value = proc(env)
+            if value is False:
+                return value
+        return last(env)
+    return and_form
+
+def analyze_or_form(expressions, scope, tail):
+    """Analyze a (short-circuited) or form."""
+    if expressions is nil:
+        return lambda env: False
+    procs = []
+    while expressions.second is not nil:
+        procs.append(analyze(expressions.first, scope))
+        expressions = expressions.second
+    last = analyze(expressions.first, scope, tail)
+    def or_form(env):
+        for proc in procs:
+            value = proc(env)
+            if value is not False:
+                return value
+        return last(env)
+    return or_form
+
+def analyze_cond_form(expressions, scope, tail):
+    """Analyze a cond form. A clause whose syntax is bad raises its error
+    only if it is reached."""
+    clauses = []
+    while expressions is not nil:
+        clause = expressions.first
+        try:
+            check_form(clause, 1)
+            if clause.first == 'else':
+                if expressions.second != nil:
+                    raise lispError('else must be last')
+                test = lambda env: True
+            else:
+                test = analyze(clause.first, scope)
+        except lispError as err:
+            clauses.append((analyze_error(err), None))
+            break
+        if clause.second is nil:
+            clauses.append((test, None))
+        else:
+            clauses.append((test, analyze_sequence(clause.second, scope, tail)))
+        expressions = expressions.second
+    def cond_form(env):
+        for test, body in clauses:
+            value = test(env)
+            if value is not False:
+                if body is None:
+                    return value
+                return body(env)
+    return cond_form
+
+def analyze_let_form(expressions, scope, tail):
+    """Analyze a let form. As in make_let_frame, a bad binding raises its
+    error after the values of the bindings before it are evaluated."""
+    check_form(expressions, 2)
+    bindings = expressions.first
+    if not lisp_listp(bindings):
+        raise lispError('bad bindings list in let form')
+    formals, value_procs, error = nil, [], None
+    layout = {}
+    while bindings is not nil:
+        try:
+            check_form(bindings.first, 2, 2)
+        except lispError as err:
+            error = err
+            break
+        formals = Pair(bindings.first.first, formals)
+        value_procs.append(analyze(bindings.first.second.first, scope))
+        if lisp_symbolp(bindings.first.first):
+            layout[bindings.first.first] = len(layout)
+        bindings = bindings.second
+    if error is None:
+        try:
+            check_formals(formals)
+        except lispError as err:
+            error = err
+    let_layout(layout, expressions.second)
+    body = analyze_sequence(expressions.second, Scope(layout, scope), tail)
+    unassigned = [UNASSIGNED] * (len(layout) - len(value_procs))
+    def let_form(env):
+        values = [proc(env) for proc in value_procs]
+        if error is not None:
+            raise type(error)(*error.args)
+        return body(LocalFrame(layout, values + unassigned, env))
+    return let_form
+
+def let_layout(layout, body):
+    """Add a slot to LAYOUT, the layout of the bindings of a let form, for
+    each symbol that its BODY defines."""
+    for symbol in scan_defines(body):
+        if symbol not in layout:
+            layout[symbol] = len(layout)
+    return layout
+
+ANALYZERS = {
+    'and': analyze_and_form,
+    'begin': analyze_begin_form,
+    'cond': analyze_cond_form,
+    'define': analyze_define_form,
+    'if': analyze_if_form,
+    'lambda': analyze_lambda_form,
+    'let': analyze_let_form,
+    'or': analyze_or_form,
+    'quote': analyze_quote_form,
+    'mu': analyze_mu_form,
+}
+
+
+# Macro expansion
+# A call of a macro is expanded the first time it is evaluated, and the
+# analyzed expansion is kept with the call. It is expanded again only if its
+# operator evaluates to a different macro, as it does after the macro is
+# redefined. expand_macros instead expands every call of a macro that is
+# already defined before an expression is evaluated at all.
+
+def expand_macros(expr, env, bound=frozenset()):
+    """Return EXPR with each call of a macro bound in the global frame ENV
+    replaced by its expansion. Symbols in BOUND, and those bound by the
+    procedures and let forms within EXPR, are local names that never refer to
+    macros. Quoted data and calls of macros not yet defined are unchanged.
+
+    >>> env = create_global_frame()
+    >>> lisp_eval(read_line("(define-macro (twice e) (list 'begin e e))"), env)
+    'twice'
+    >>> print(expand_macros(read_line("(lambda (x) (twice (twice x)))"), env))
+    (lambda (x) (begin (begin x x) (begin x x)))
+    >>> print(expand_macros(read_line("(lambda (twice) (twice '(twice x)))"), env))
+    (lambda (twice) (twice (quote (twice x))))
+    """
+    if not (isinstance(env, Frame) and isinstance(expr, Pair)
+            and lisp_listp(expr)):
+        return expr
+    first, rest = expr.first, expr.second
+    if lisp_symbolp(first) and first in SPECIAL_FORMS:
+        if first not in EXPANDERS:
+            return expr
+        return Pair(first, EXPANDERS[first](rest, env, bound))
+    if lisp_symbolp(first) and first not in bound:
+        macro = env.bindings.get(first)
+        if isinstance(macro, MacroProcedure):
+            return expand_macros(macro.apply_macro(rest, env), env, bound)
+    return expr.map(lambda e: expand_macros(e, env, bound))
+
+def expand_operands(expressions, env, bound):
+    """Expand each expression in the lisp list EXPRESSIONS."""
+    return expressions.map(lambda e: expand_macros(e, env, bound))
+
+def expand_body(formals, body, env, bound):
+    """Expand BODY, in which FORMALS and the symbols BODY defines are bound."""
+    bound = set(bound)
+    while isinstance(formals, Pair):
+        bound.add(formals.first)
+        formals = formals.second
+    bound.update(scan_defines(body))
+    return expand_operands(body, env, bound)
+
+def expand_define_form(expressions, env, bound):
+    """Expand the operands of a define form."""
+    if expressions is nil:
+        return expressions
+    target = expressions.first
+    if isinstance(target, Pair):
+        return Pair(target, expand_body(target.second, expressions.second,
+                                        env, bound))
+    return Pair(target, expand_operands(expressions.second, env, bound))
+
+def expand_lambda_form(expressions, env, bound):
+    """Expand the operands of a lambda or mu form."""
+    if expressions is nil:
+        return expressions
+    return Pair(expressions.first, expand_body(expressions.first,
+                                               expressions.second, env, bound))
+
+def expand_cond_form(expressions, env, bound):
+    """Expand the operands of a cond form."""
+    return expressions.map(lambda clause: expand_operands(clause, env, bound)
+                           if isinstance(clause, Pair) and lisp_listp(clause)
+                           else clause)
+
+def expand_let_form(expressions, env, bound):
+    """Expand the operands of a let form."""
+    if expressions is nil or not lisp_listp(expressions.first):
+        return expressions
+    names, bindings = nil, expressions.first
+    while bindings is not nil:
+        if isinstance(bindings.first, Pair):
+            names = Pair(bindings.first.first, names)
+        bindings = bindings.second
+    bindings = expressions.first
+    def expand_binding(binding):
+        if isinstance(binding, Pair) and lisp_listp(binding):
+            return Pair(binding.first, expand_operands(binding.second, env, bound))
+        return binding
+    return Pair(bindings.map(expand_binding),
+                expand_body(names, expressions.second, env, bound))
+
+EXPANDERS = {
+    'and': expand_operands,
+    'begin': expand_operands,
+    'cond': expand_cond_form,
+    'cons-stream': expand_operands,
+    'define': expand_define_form,
+    'delay': expand_operands,
+    'if': expand_operands,
+    'lambda': expand_lambda_form,
+    'let': expand_let_form,
+    'mu': expand_lambda_form,
+    'or': expand_operands,
+}
+
+def expanding(evaluate):
+    """Return a function that evaluates an expression with EVALUATE after
+    expanding its macros. Symbols that the expression itself defines are not
+    treated as macros."""
+    def evaluate_expanded(expr, env):
+        bound = scan_defines(Pair(expr, nil))
+        return evaluate(expand_macros(expr, env, frozenset(bound)), env)
+    return evaluate_expanded
+
+
 # Extra Procedures 
-def lisp_map(fn, s, env):
-    check_type(fn, lisp_procedurep, 0, 'map')
-    check_type(s, lisp_listp, 1, 'map')
-    return s.map(lambda x: complete_apply(fn, Pair(x, nil), env))
+def procedure_caller(fn, n, env, name):
+    """Return a Python function that applies FN, argument 0 of NAME and a
+    lisp procedure, to N arguments in ENV. The work of each call that does
+    not depend on the arguments, such as checking the number of arguments
+    to a builtin, is done once here instead."""
+    check_type(fn, lisp_procedurep, 0, name)
+    if isinstance(fn, BuiltinProcedure):
+        if n < fn.min_args or fn.max_args is not None and n > fn.max_args:
+            raise lispError(fn.arity_message(n))
+        py_fn = fn.fn
+        if fn.use_env:
+            return lambda *args: py_fn(*(args + (env,)))
+        return py_fn
+    if isinstance(fn, LambdaProcedure) and fn.arity == n:
+        analyzed, layout, parent = fn.analyzed, fn.layout, fn.env
+        unassigned = [UNASSIGNED] * (len(layout) - n)
+        if n == 1:
+            def call(x):
+                return execute(analyzed, LocalFrame(layout, [x] + unassigned,
+                                                    parent))
+        else:
+            def call(*args):
+                return execute(analyzed, LocalFrame(
+                    layout, list(args) + unassigned, parent))
+        return call
+    return lambda *args: lisp_call(fn, list(args), env)
+
+def lisp_map(fn, *args):
+    lists, env = args[:-1], args[-1]
+    columns = [list_items(s, i + 1, 'map') for i, s in enumerate(lists)]
+    call = procedure_caller(fn, len(lists), env, 'map')
+    if len(columns) == 1:
+        return lisp_list(*[call(x) for x in columns[0]])
+    return lisp_list(*[call(*vals) for vals in zip(*columns)])
+
+lisp_map.arity = (3, None)  # FN, one or more lists, and env
 
 def lisp_filter(fn, s, env):
-    check_type(fn, lisp_procedurep, 0, 'filter')
-    check_type(s, lisp_listp, 1, 'filter')
-    head, current = nil, nil
-    while s is not nil:
-        item, s = s.first, s.second
-        if complete_apply(fn, Pair(item, nil), env):
-            if head is nil:
-                head = Pair(item, nil)
-                current = head
-            else:
-                current.second = Pair(item, nil)
-                current = current.second
-    return head
+    call = procedure_caller(fn, 1, env, 'filter')
+    items = list_items(s, 1, 'filter')
+    return lisp_list(*[item for item in items if call(item) is not False])
 
 def lisp_reduce(fn, s, env):
-    check_type(fn, lisp_procedurep, 0, 'reduce')
     check_type(s, lambda x: x is not nil, 1, 'reduce')
-    check_type(s, lisp_listp, 1, 'reduce')
-    value, s = s.first, s.second
-    while s is not nil:
-        value = complete_apply(fn, lisp_list(value, s.first), env)
-        s = s.second
+    call = procedure_caller(fn, 2, env, 'reduce')
+    items = list_items(s, 1, 'reduce')
+    value = items[0]
+    for item in items[1:]:
+        value = call(value, item)
     return value
 
+def lisp_vector_map(fn, *args):
+    vectors, env = args[:-1], args[-1]
+    for i, v in enumerate(vectors):
+        check_type(v, lisp_vectorp, i + 1, 'vector-map')
+    call = procedure_caller(fn, len(vectors), env, 'vector-map')
+    return Vector([call(*vals) for vals in zip(*vectors)])
+
+lisp_vector_map.arity = (3, None)  # FN, one or more vectors, and env
+
+def lisp_hash_table_walk(table, fn, env):
+    check_type(table, lisp_hash_tablep, 0, 'hash-table-walk')
+    check_type(fn, lisp_procedurep, 1, 'hash-table-walk')
+    call = procedure_caller(fn, 2, env, 'hash-table-walk')
+    for key, value in list(table.entries.items()):
+        call(key.value, value)
+
+# Parallelism
+# parallel-map and future run lisp procedures in a pool of worker processes.
+# A procedure is sent to a worker by pickling its formals, its body, and the
+# local frames that it closes over, along with the values of the global
+# bindings that it, or any procedure sent with it, refers to. The global
+# frame itself and the builtins are never sent: a worker started by fork
+# inherits a copy-on-write copy of the global frame as it was when the pool
+# started, and any other worker creates a new one. Either way, the global
+# bindings that were sent are defined there before the procedure is called.
+# A worker's changes to the values it was sent are not seen here, so only
+# procedures without side effects should be run in parallel.
+
+WORKERS = None  # The number of worker processes (None: one for each CPU)
+START_METHOD = None  # How workers are started (None: as multiprocessing
+                     # does by default on this platform)
+CHUNKS_PER_WORKER = 4  # The tasks per worker that parallel-map makes
+
+_pool = None  # The pool of worker processes, started when first needed
+_parallel_env = None  # The global frame that pickled procedures refer to
+_unanalyzed = []  # Procedures unpickled but not yet analyzed
+
+class ProcedurePickler(pickle.Pickler):
+    """A Pickler of lisp values, including procedures, that refer to the
+    global frame ENV. It collects in GLOBALS the bindings in ENV that the
+    procedures it pickles refer to, except for unchanged builtins."""
+
+    def __init__(self, file, env):
+        super(ProcedurePickler, self).__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.env = env
+        self.globals = {}
+
+    def reducer_override(self, obj):
+        if obj is self.env:
+            return _global_frame, ()
+        if obj is UNASSIGNED:
+            return _unassigned, ()
+        if isinstance(obj, BuiltinProcedure):
+            return _builtin, (obj.name,)
+        if isinstance(obj, LambdaProcedure):
+            # The environment is set after the procedure is created, since
+            # it may hold the procedure itself.
+            self.refer(obj.body)
+            if isinstance(obj, MacroProcedure):
+                kind = MacroProcedure
+            else:
+                kind = LambdaProcedure
+            return (_new_procedure, (kind, obj.formals, obj.body), obj.env,
+                    None, None, _set_procedure_env)
+        if isinstance(obj, MuProcedure):
+            self.refer(obj.body)
+            return MuProcedure, (obj.formals, obj.body)
+        if isinstance(obj, LocalFrame):
+            return (_new_local_frame, (obj.layout,),
+                    (obj.values, obj.parent, obj.extras), None, None,
+                    _set_local_frame)
+        return NotImplemented
+
+    def refer(self, expr):
+        """Add to GLOBALS the bindings of the symbols in EXPR."""
+        bindings, exprs = self.env.bindings, [expr]
+        while exprs:
+            expr = exprs.pop()
+            while isinstance(expr, Pair):
+                exprs.append(expr.first)
+                expr = expr.second
+            if lisp_symbolp(expr) and expr in bindings:
+                value = bindings[expr]
+                unchanged = (isinstance(value, BuiltinProcedure) and
+                             value.name == expr)
+                if not unchanged:
+                    self.globals.setdefault(expr, value)
+
+def _global_frame():
+    return _parallel_env
+
+def _unassigned():
+    return UNASSIGNED
+
+def _builtin(name):
+    return _parallel_env.lookup(name)
+
+def _new_procedure(kind, formals, body):
+    procedure = object.__new__(kind)
+    procedure.formals, procedure.body = formals, body
+    procedure.arity = len(formals) if isinstance(formals, Pair) else 0
+    _unanalyzed.append(procedure)
+    return procedure
+
+def _set_procedure_env(procedure, env):
+    procedure.env = env
+
+def _new_local_frame(layout):
+    return LocalFrame(layout, None, None)
+
+def _set_local_frame(frame, state):
+    frame.values, frame.parent, frame.extras = state
+
+def dumps(value, env, send_globals=True):
+    """Return VALUE, which refers to the global frame ENV, pickled along
+    with the global bindings that its procedures refer to if SEND_GLOBALS.
+
+    >>> env = create_global_frame()
+    >>> lisp_eval(read_line('(define (f x) (* x k))'), env)
+    'f'
+    >>> lisp_eval(read_line('(define k 3)'), env)
+    'k'
+    >>> data = dumps(env.lookup('f'), env)
+    >>> other = create_global_frame()
+    >>> f = loads(data, other)
+    >>> other.lookup('k'), lisp_call(f, [2], other)
+    (3, 6)
+    """
+    file = io.BytesIO()
+    pickler = ProcedurePickler(file, env)
+    try:
+        pickler.dump(value)
+        sent = set()
+        while send_globals and len(sent) < len(pickler.globals):
+            for symbol in list(pickler.globals):
+                if symbol not in sent:
+                    sent.add(symbol)
+                    pickler.dump((symbol, pickler.globals[symbol]))
+        pickler.dump(None)
+    except (pickle.PicklingError, TypeError, AttributeError,
+            RecursionError) as err:
+        raise lispError('cannot send a value to another process: '
+                        '{0}'.format(err))
+    return file.getvalue()
+
+def loads(data, env):
+    """Return the value pickled in DATA by dumps, defining in the global
+    frame ENV the bindings pickled with it."""
+    global _parallel_env
+    _parallel_env = env
+    del _unanalyzed[:]
+    unpickler = pickle.Unpickler(io.BytesIO(data))
+    value = unpickler.load()
+    binding = unpickler.load()
+    while binding is not None:
+        env.define(*binding)
+        binding = unpickler.load()
+    while _unanalyzed:
+        procedure = _unanalyzed.pop()
+        procedure.layout, procedure.analyzed = analyze_body(
+            procedure.formals, procedure.body, procedure.env)
+    return value
+
+def global_frame(env):
+    """Return the global frame at the root of environment ENV."""
+    while env.parent is not None:
+        env = env.parent
+    return env
+
+def worker_pool(env):
+    """Return the pool of worker processes, starting it if need be. Workers
+    started by fork inherit ENV as their global frame."""
+    global _pool, _parallel_env
+    if _pool is None:
+        import concurrent.futures
+        import multiprocessing
+        context = multiprocessing.get_context(START_METHOD)
+        forked = context.get_start_method() == 'fork'
+        _parallel_env = env
+        _pool = concurrent.futures.ProcessPoolExecutor(
+            WORKERS, context, initializer=_start_worker, initargs=(forked,))
+    return _pool
+
+def pool_size():
+    """Return the number of worker processes in the pool."""
+    if WORKERS is not None:
+        return WORKERS
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+def _start_worker(forked):
+    global _parallel_env
+    if not forked:
+        _parallel_env = create_global_frame()
+
+def _map_chunk(fn_data, chunk_data):
+    fn = loads(fn_data, _parallel_env)
+    chunk = loads(chunk_data, _parallel_env)
+    results = [lisp_call(fn, [item], _parallel_env) for item in chunk]
+    return dumps(results, _parallel_env, False)
+
+def _touch_thunk(data):
+    thunk = loads(data, _parallel_env)
+    return dumps(lisp_call(thunk, [], _parallel_env), _parallel_env, False)
+
+def lisp_parallel_map(fn, s, *args):
+    """Return a list of FN applied to each element of list S, as map does,
+    but computed by the worker processes in tasks of CHUNK elements each,
+    where CHUNK is an optional argument."""
+    chunk, env = args[:-1], global_frame(args[-1])
+    check_type(fn, lisp_procedurep, 0, 'parallel-map')
+    items = list_items(s, 1, 'parallel-map')
+    if chunk:
+        chunk = chunk[0]
+        check_type(chunk, lambda x: type(x) is int and x > 0, 2,
+                   'parallel-map')
+    else:
+        chunk = -(-len(items) // (pool_size() * CHUNKS_PER_WORKER)) or 1
+    fn_data = dumps(fn, env)
+    pool = worker_pool(env)
+    tasks = [pool.submit(_map_chunk, fn_data, dumps(items[i:i + chunk], env))
+             for i in range(0, len(items), chunk)]
+    results = []
+    for task in tasks:
+        results.extend(loads(task.result(), env))
+    return lisp_list(*results)
+
+lisp_parallel_map.arity = (3, 4)  # FN, S, an optional CHUNK, and env
+
+class Future(object):
+    """The value of an expression that is evaluated by a worker process."""
+
+    def __init__(self, task, env):
+        self.task = task
+        self.env = env
+
+    def touch(self):
+        """Wait for the value of my expression, and return it."""
+        if self.task is not None:
+            self.value = loads(self.task.result(), self.env)
+            self.task = None
+        return self.value
+
+    def __str__(self):
+        done = self.task is None or self.task.done()
+        return '#[future ({0}done)]'.format('' if done else 'not ')
+
+def do_future_form(expressions, env):
+    """Evaluate a future form, which starts evaluating its expression in a
+    worker process."""
+    check_form(expressions, 1, 1)
+    thunk = LambdaProcedure(nil, expressions, env)
+    root = global_frame(env)
+    task = worker_pool(root).submit(_touch_thunk, dumps(thunk, root))
+    return Future(task, root)
+
+SPECIAL_FORMS['future'] = do_future_form
+
+def lisp_touch(x):
+    """Return the value of X if it is a future, or X itself otherwise."""
+    if isinstance(x, Future):
+        return x.touch()
+    return x
 
 # Input/Output 
+
 def read_eval_print_loop(next_line, env, interactive=False, quiet=False,
-                         startup=False, load_files=(), report_errors=False):
-    """Read and evaluate input until an end of file or keyboard interrupt."""
+                         startup=False, load_files=(), report_errors=False,
+                         evaluate=None, read=lisp_read):
+    """Read and evaluate input until an end of file or keyboard interrupt.
+    Expressions are read by READ and evaluated by EVALUATE (default:
+    lisp_eval)."""
+    if evaluate is None:
+        evaluate = lisp_eval
     if startup:
+        # EVALUATE already expands macros if the loop's expressions do.
         for filename in load_files:
-            lisp_load(filename, True, env)
+            lisp_load(String(filename), True, env, evaluate=evaluate,
+                      expand=False)
     while True:
         try:
             src = next_line()
             while src.more_on_line:
-                expression = lisp_read(src)
-                result = lisp_eval(expression, env)
+                expression = read(src)
+                result = evaluate(expression, env)
                 if not quiet and result is not None:
                     print(repl_str(result))
         except (lispError, SyntaxError, ValueError, RuntimeError) as err:
@@ -616,10 +1843,31 @@ def read_eval_print_loop(next_line, env, interactive=False, quiet=False,
             print()
             return
 
-def lisp_load(*args):
+LOAD_CACHE = True  # Whether load reads and writes lisp_cache entries
+EXPAND_MACROS = False  # Whether load expands macros before evaluating
+
+def lisp_load(*args, evaluate=None, expand=None):
     """Load a lisp source file. ARGS should be of the form (SYM, ENV) or
     (SYM, QUIET, ENV). The file named SYM is loaded into environment ENV,
-    with verbosity determined by QUIET (default true)."""
+    with verbosity determined by QUIET (default true). Its expressions are
+    evaluated by EVALUATE (default: lisp_eval), after their macros are
+    expanded by expand_macros if EXPAND (default: EXPAND_MACROS). A quiet
+    load evaluates the expressions in the file's lisp_cache entry if it has a
+    valid one, and otherwise writes one as it reads the file, unless reading
+    it fails.
+
+    >>> import os, tempfile
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'bad.scm')
+    >>> with open(filename, 'w') as outfile:
+    ...     _ = outfile.write('(define a{b 2)\\n(define c 3)\\n')
+    >>> env = create_global_frame()
+    >>> for _ in range(2):
+    ...     lisp_load(String(filename), env)  # doctest: +NORMALIZE_WHITESPACE
+    Error: invalid numeral or symbol: a{b
+    Error: invalid numeral or symbol: a{b
+    >>> os.path.exists(lisp_cache.cache_path(filename)), env.lookup('c')
+    (False, 3)
+    """
     if not (2 <= len(args) <= 3):
         expressions = args[:-1]
         raise lispError('"load" given incorrect number of arguments: '
@@ -627,16 +1875,55 @@ def lisp_load(*args):
     sym = args[0]
     quiet = args[1] if len(args) > 2 else True
     env = args[-1]
-    if (lisp_stringp(sym)):
-        sym = eval(sym)
-    check_type(sym, lisp_symbolp, 0, 'load')
+    if lisp_stringp(sym):
+        sym = sym.text
+    else:
+        check_type(sym, lisp_symbolp, 0, 'load')
+    evaluate = evaluate or lisp_eval
+    if expand is None:
+        expand = EXPAND_MACROS
+    if expand:
+        evaluate = expanding(evaluate)
+    # Lines are read from the file as they are needed, so only those of the
+    # expression being read are held in memory.
     with lisp_open(sym) as infile:
-        lines = infile.readlines()
-    args = (lines, None) if quiet else (lines,)
-    def next_line():
-        return buffer_lines(*args)
-
-    read_eval_print_loop(next_line, env, quiet=quiet, report_errors=True)
+        args = (infile, None) if quiet else (infile,)
+        def next_line():
+            return buffer_lines(*args)
+        if not (quiet and LOAD_CACHE):
+            read_eval_print_loop(next_line, env, quiet=quiet,
+                                 report_errors=True, evaluate=evaluate)
+            return
+        key = lisp_cache.source_key(infile)
+        expressions = lisp_cache.read_cache(infile.name, key)
+        if expressions is not None:
+            forms = lisp_cache.CachedForms(expressions)
+            read_eval_print_loop(lambda: forms, env, quiet=True,
+                                 report_errors=True, evaluate=evaluate,
+                                 read=lisp_cache.read_form)
+            return
+        writer = lisp_cache.CacheWriter(infile.name, key)
+        def evaluate_and_cache(expr, env):
+            writer.add(expr)
+            return evaluate(expr, env)
+        def reading(read):
+            """Return READ, which discards the entry if it fails."""
+            def read_or_discard(*args):
+                try:
+                    return read(*args)
+                except (SyntaxError, ValueError):
+                    writer.discard()
+                    raise
+            return read_or_discard
+        try:
+            read_eval_print_loop(reading(next_line), env, quiet=True,
+                                 report_errors=True,
+                                 evaluate=evaluate_and_cache,
+                                 read=reading(lisp_read))
+        except BaseException:
+            writer.discard()
+            raise
+        writer.commit()
 
 def lisp_open(filename):
     """If either FILENAME or FILENAME.scm is the name of a valid file,
@@ -651,28 +1938,51 @@ def lisp_open(filename):
     except IOError as exc:
         raise lispError(str(exc))
 
+_builtin_table = None  # The bindings that every global frame starts with
+
+def builtin_table():
+    """Return a read-only mapping of the built-in names to their values,
+    which is built on the first call and shared by all global frames."""
+    global _builtin_table
+    if _builtin_table is None:
+        env = Frame(None)
+        env.define('eval', eval_procedure(lisp_eval))
+        env.define('apply',
+                   BuiltinProcedure(complete_apply, True, 'apply'))
+        env.define('load',
+                   BuiltinProcedure(lisp_load, True, 'load'))
+        env.define('procedure?',
+                   BuiltinProcedure(lisp_procedurep, False, 'procedure?'))
+        env.define('map',
+                   BuiltinProcedure(lisp_map, True, 'map'))
+        env.define('filter',
+                   BuiltinProcedure(lisp_filter, True, 'filter'))
+        env.define('reduce',
+                   BuiltinProcedure(lisp_reduce, True, 'reduce'))
+        env.define('vector-map',
+                   BuiltinProcedure(lisp_vector_map, True, 'vector-map'))
+        env.define('hash-table-walk',
+                   BuiltinProcedure(lisp_hash_table_walk, True,
+                                    'hash-table-walk'))
+        env.define('parallel-map',
+                   BuiltinProcedure(lisp_parallel_map, True, 'parallel-map'))
+        env.define('touch',
+                   BuiltinProcedure(lisp_touch, False, 'touch'))
+        env.define('inline-cache-stats',
+                   BuiltinProcedure(lambda: lisp_list(*inline_cache_stats()),
+                                    False, 'inline-cache-stats'))
+        env.define('undefined', None)
+        add_builtins(env, BUILTINS)
+        _builtin_table = types.MappingProxyType(env.bindings)
+    return _builtin_table
+
 def create_global_frame():
     """Initialize and return a single-frame environment with built-in names."""
     env = Frame(None)
-    env.define('eval',
-               BuiltinProcedure(lisp_eval, True, 'eval'))
-    env.define('apply',
-               BuiltinProcedure(complete_apply, True, 'apply'))
-    env.define('load',
-               BuiltinProcedure(lisp_load, True, 'load'))
-    env.define('procedure?',
-               BuiltinProcedure(lisp_procedurep, False, 'procedure?'))
-    env.define('map',
-               BuiltinProcedure(lisp_map, True, 'map'))
-    env.define('filter',
-               BuiltinProcedure(lisp_filter, True, 'filter'))
-    env.define('reduce',
-               BuiltinProcedure(lisp_reduce, True, 'reduce'))
-    env.define('undefined', None)
-    add_builtins(env, BUILTINS)
+    env.bindings = builtin_table().copy()
+    env.version += 1
     return env
 
-@main
 def run(*argv):
     import argparse
     parser = argparse.ArgumentParser(description='CS 61A lisp Interpreter')
@@ -681,6 +1991,28 @@ def run(*argv):
     parser.add_argument('file', nargs='?',
                         type=argparse.FileType('r'), default=None,
                         help='lisp file to run')
+    parser.add_argument('--engine', choices=['eval', 'vm'], default='eval',
+                        help='evaluate with lisp_eval (default) or compile '
+                             'to bytecode for the virtual machine')
+    parser.add_argument('--max-depth', type=int, default=None,
+                        help='the deepest recursion between compiled '
+                             'procedures in the virtual machine (default: '
+                             '100000); the eval engine is limited by the '
+                             'Python recursion limit instead')
+    parser.add_argument('--expand-macros', action='store_true',
+                        help='expand the macros in each expression before '
+                             'evaluating it')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='the number of worker processes for '
+                             'parallel-map and future (default: one for '
+                             'each CPU)')
+    parser.add_argument('--start-method', default=None,
+                        choices=['fork', 'spawn', 'forkserver'],
+                        help='how worker processes are started (default: '
+                             'the default of multiprocessing)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='read loaded files from source, without '
+                             'reading or writing their cache entries')
     args = parser.parse_args()
 
 
@@ -692,11 +2024,28 @@ def run(*argv):
         if args.load:
             load_files.append(getattr(args.file, 'name'))
         else:
-            lines = args.file.readlines()
             def next_line():
-                return buffer_lines(lines)
+                return buffer_lines(args.file)
             interactive = False
 
-    read_eval_print_loop(next_line, create_global_frame(), startup=True,
-                         interactive=interactive, load_files=load_files)
+    global WORKERS, START_METHOD, LOAD_CACHE, EXPAND_MACROS
+    WORKERS = args.workers
+    START_METHOD = args.start_method
+    LOAD_CACHE = not args.no_cache
+    EXPAND_MACROS = args.expand_macros
+
+    if args.engine == 'vm':
+        import lisp_vm
+        if args.max_depth is not None:
+            lisp_vm.MAX_DEPTH = args.max_depth
+        evaluate, env = lisp_vm.vm_eval, lisp_vm.create_vm_global_frame()
+        expand = lisp_vm.expanding
+    else:
+        evaluate, env, expand = lisp_eval, create_global_frame(), expanding
+    if args.expand_macros:
+        evaluate = expand(evaluate)
+
+    read_eval_print_loop(next_line, env, startup=True,
+                         interactive=interactive, load_files=load_files,
+                         evaluate=evaluate)
     tlisp_exitonclick()
\ No newline at end of file
@@ -0,0 +1,347 @@
+"""Persistent maps and vectors for the lisp language.
+
+Persistent values never change. Updating one returns a new value that shares
+all but O(log32 n) of its structure with the old one, so every version stays
+valid and cheap to keep. Maps are hash array mapped tries (HAMTs) and vectors
+are bit-partitioned tries of 32-way nodes with a separate tail, as in Clojure.
+"""
+
+from __future__ import print_function  # Python 2 compatibility
+
+import operator
+
+BITS = 5  # Bits of a hash or index consumed by each level of a trie
+WIDTH = 1 << BITS  # Children per node
+MASK = WIDTH - 1
+HASH_BITS = 64  # Hashes are truncated to this many bits
+
+def _popcount(n):
+    """Return the number of ones in the binary representation of N."""
+    return bin(n).count('1')
+
+# Maps
+
+class _BitmapNode(object):
+    """A node of a map. ITEMS holds one child for each one in BITMAP: either
+    an entry (hash, key, value) or another node."""
+    __slots__ = ('bitmap', 'items')
+
+    def __init__(self, bitmap, items):
+        self.bitmap = bitmap
+        self.items = items
+
+class _CollisionNode(object):
+    """A node of a map holding the entries (key, value) of keys that share
+    the same HASH."""
+    __slots__ = ('hash', 'entries')
+
+    def __init__(self, hash, entries):
+        self.hash = hash
+        self.entries = entries
+
+_EMPTY_NODE = _BitmapNode(0, ())
+
+def _merge(shift, entry, other):
+    """Return a node holding two entries with different keys."""
+    if shift >= HASH_BITS or entry[0] == other[0]:
+        return _CollisionNode(entry[0], ((entry[1], entry[2]),
+                                         (other[1], other[2])))
+    i, j = (entry[0] >> shift) & MASK, (other[0] >> shift) & MASK
+    if i == j:
+        return _BitmapNode(1 << i, (_merge(shift + BITS, entry, other),))
+    items = (entry, other) if i < j else (other, entry)
+    return _BitmapNode((1 << i) | (1 << j), items)
+
+def _collapse(node):
+    """Return NODE, or the entry it holds if it holds nothing else."""
+    if isinstance(node, _BitmapNode):
+        if len(node.items) == 1 and type(node.items[0]) is tuple:
+            return node.items[0]
+    elif len(node.entries) == 1:
+        return (node.hash,) + node.entries[0]
+    return node
+
+def _assoc(node, shift, h, key, value, equal):
+    """Return a node like NODE in which KEY has VALUE, and whether KEY is
+    new."""
+    if isinstance(node, _CollisionNode):
+        if h != node.hash:
+            i, j = (node.hash >> shift) & MASK, (h >> shift) & MASK
+            if i == j:
+                child, added = _assoc(node, shift + BITS, h, key, value, equal)
+                return _BitmapNode(1 << i, (child,)), added
+            new = (h, key, value)
+            items = (node, new) if i < j else (new, node)
+            return _BitmapNode((1 << i) | (1 << j), items), True
+        entries = list(node.entries)
+        for k, (other, _) in enumerate(entries):
+            if equal(other, key):
+                entries[k] = (key, value)
+                return _CollisionNode(h, tuple(entries)), False
+        entries.append((key, value))
+        return _CollisionNode(h, tuple(entries)), True
+    bit = 1 << ((h >> shift) & MASK)
+    index = _popcount(node.bitmap & (bit - 1))
+    if not node.bitmap & bit:
+        items = node.items[:index] + ((h, key, value),) + node.items[index:]
+        return _BitmapNode(node.bitmap | bit, items), True
+    item = node.items[index]
+    if type(item) is tuple:
+        if item[0] == h and equal(item[1], key):
+            child, added = (h, key, value), False
+        else:
+            child, added = _merge(shift + BITS, item, (h, key, value)), True
+    else:
+        child, added = _assoc(item, shift + BITS, h, key, value, equal)
+    items = node.items[:index] + (child,) + node.items[index + 1:]
+    return _BitmapNode(node.bitmap, items), added
+
+def _dissoc(node, shift, h, key, equal):
+    """Return a node like NODE without KEY, or NODE itself if KEY is
+    absent."""
+    if isinstance(node, _CollisionNode):
+        if h != node.hash:
+            return node
+        entries = tuple(e for e in node.entries if not equal(e[0], key))
+        if len(entries) == len(node.entries):
+            return node
+        return _CollisionNode(h, entries)
+    bit = 1 << ((h >> shift) & MASK)
+    if not node.bitmap & bit:
+        return node
+    index = _popcount(node.bitmap & (bit - 1))
+    item = node.items[index]
+    if type(item) is tuple:
+        if not (item[0] == h and equal(item[1], key)):
+            return node
+        items = node.items[:index] + node.items[index + 1:]
+        return _BitmapNode(node.bitmap & ~bit, items)
+    child = _dissoc(item, shift + BITS, h, key, equal)
+    if child is item:
+        return node
+    items = node.items[:index] + (_collapse(child),) + node.items[index + 1:]
+    return _BitmapNode(node.bitmap, items)
+
+def _entries(node):
+    """Yield the pairs (key, value) under NODE."""
+    if isinstance(node, _CollisionNode):
+        for entry in node.entries:
+            yield entry
+        return
+    for item in node.items:
+        if type(item) is tuple:
+            yield item[1], item[2]
+        else:
+            for entry in _entries(item):
+                yield entry
+
+class PersistentMap(object):
+    """An immutable map from keys to values. Keys are hashed with HASH and
+    compared with EQUAL.
+
+    >>> m = PersistentMap().assoc('a', 1).assoc('b', 2)
+    >>> m.get('a'), m.get('c', 0), len(m)
+    (1, 0, 2)
+    >>> n = m.assoc('a', 3).dissoc('b')
+    >>> sorted(m.items()), sorted(n.items())
+    ([('a', 1), ('b', 2)], [('a', 3)])
+    """
+    __slots__ = ('root', 'count', 'hash', 'equal')
+
+    def __init__(self, hash=hash, equal=operator.eq, root=_EMPTY_NODE,
+                 count=0):
+        self.root = root
+        self.count = count
+        self.hash = hash
+        self.equal = equal
+
+    def _hash(self, key):
+        return self.hash(key) & ((1 << HASH_BITS) - 1)
+
+    def _with(self, root, count):
+        return PersistentMap(self.hash, self.equal, root, count)
+
+    def get(self, key, default=None):
+        """Return the value of KEY, or DEFAULT if it has none."""
+        h, node, shift = self._hash(key), self.root, 0
+        while True:
+            if isinstance(node, _CollisionNode):
+                if h == node.hash:
+                    for other, value in node.entries:
+                        if self.equal(other, key):
+                            return value
+                return default
+            bit = 1 << ((h >> shift) & MASK)
+            if not node.bitmap & bit:
+                return default
+            item = node.items[_popcount(node.bitmap & (bit - 1))]
+            if type(item) is tuple:
+                if item[0] == h and self.equal(item[1], key):
+                    return item[2]
+                return default
+            node, shift = item, shift + BITS
+
+    def __contains__(self, key):
+        missing = object()
+        return self.get(key, missing) is not missing
+
+    def assoc(self, key, value):
+        """Return a map like SELF in which KEY has VALUE."""
+        root, added = _assoc(self.root, 0, self._hash(key), key, value,
+                             self.equal)
+        return self._with(root, self.count + added)
+
+    def dissoc(self, key):
+        """Return a map like SELF in which KEY has no value."""
+        root = _dissoc(self.root, 0, self._hash(key), key, self.equal)
+        if root is self.root:
+            return self
+        return self._with(root, self.count - 1)
+
+    def items(self):
+        """Return an iterator over the pairs (key, value) of SELF."""
+        return _entries(self.root)
+
+    def __iter__(self):
+        return (key for key, _ in _entries(self.root))
+
+    def __len__(self):
+        return self.count
+
+# Vectors
+
+def _new_path(level, node):
+    """Return NODE beneath LEVEL / BITS new nodes of one child each."""
+    while level > 0:
+        node, level = (node,), level - BITS
+    return node
+
+class PersistentVector(object):
+    """An immutable sequence. The last WIDTH or fewer elements are kept in
+    TAIL, and the rest in the leaves of a trie of depth SHIFT / BITS.
+
+    >>> v = PersistentVector().conj(1).conj(2).conj(3)
+    >>> w = v.assoc(0, 10).pop()
+    >>> list(v), list(w), v.nth(2)
+    ([1, 2, 3], [10, 2], 3)
+    >>> big = PersistentVector.from_iterable(range(5000))
+    >>> big.nth(4321), len(big.assoc(1234, 'x')), list(big.pop())[-1]
+    (4321, 5000, 4998)
+    """
+    __slots__ = ('count', 'shift', 'root', 'tail')
+
+    def __init__(self, count=0, shift=BITS, root=(), tail=()):
+        self.count = count
+        self.shift = shift
+        self.root = root
+        self.tail = tail
+
+    @classmethod
+    def from_iterable(cls, values):
+        """Return a vector of the elements of VALUES."""
+        v = cls()
+        for value in values:
+            v = v.conj(value)
+        return v
+
+    def _tail_offset(self):
+        if self.count < WIDTH:
+            return 0
+        return ((self.count - 1) >> BITS) << BITS
+
+    def _leaf(self, i):
+        """Return the node that holds element I."""
+        if i >= self._tail_offset():
+            return self.tail
+        node = self.root
+        for level in range(self.shift, 0, -BITS):
+            node = node[(i >> level) & MASK]
+        return node
+
+    def nth(self, i):
+        """Return element I, where 0 <= I < len(SELF)."""
+        if not 0 <= i < self.count:
+            raise IndexError('index {0} out of range'.format(i))
+        return self._leaf(i)[i & MASK]
+
+    def _push_tail(self, level, parent):
+        index = ((self.count - 1) >> level) & MASK
+        node = list(parent)
+        if level == BITS:
+            child = self.tail
+        elif index < len(parent):
+            child = self._push_tail(level - BITS, parent[index])
+        else:
+            child = _new_path(level - BITS, self.tail)
+        if index < len(node):
+            node[index] = child
+        else:
+            node.append(child)
+        return tuple(node)
+
+    def conj(self, value):
+        """Return a vector like SELF with VALUE added at the end."""
+        count, shift = self.count, self.shift
+        if count - self._tail_offset() < WIDTH:
+            return PersistentVector(count + 1, shift, self.root,
+                                    self.tail + (value,))
+        if (count >> BITS) > (1 << shift):
+            root = (self.root, _new_path(shift, self.tail))
+            shift += BITS
+        else:
+            root = self._push_tail(shift, self.root)
+        return PersistentVector(count + 1, shift, root, (value,))
+
+    def assoc(self, i, value):
+        """Return a vector like SELF with VALUE as element I."""
+        if not 0 <= i < self.count:
+            raise IndexError('index {0} out of range'.format(i))
+        if i >= self._tail_offset():
+            tail = self.tail[:i & MASK] + (value,) + self.tail[(i & MASK) + 1:]
+            return PersistentVector(self.count, self.shift, self.root, tail)
+        def replace(level, node):
+            index = (i >> level) & MASK
+            child = value if level == 0 else replace(level - BITS, node[index])
+            return node[:index] + (child,) + node[index + 1:]
+        return PersistentVector(self.count, self.shift,
+                                replace(self.shift, self.root), self.tail)
+
+    def _pop_tail(self, level, node):
+        index = ((self.count - 2) >> level) & MASK
+        if level > BITS:
+            child = self._pop_tail(level - BITS, node[index])
+            if child is None and index == 0:
+                return None
+            if child is None:
+                return node[:index]
+            return node[:index] + (child,)
+        if index == 0:
+            return None
+        return node[:index]
+
+    def pop(self):
+        """Return a vector like SELF without its last element."""
+        count = self.count
+        if count == 0:
+            raise IndexError('pop from an empty vector')
+        if count == 1:
+            return PersistentVector()
+        if count - self._tail_offset() > 1:
+            return PersistentVector(count - 1, self.shift, self.root,
+                                    self.tail[:-1])
+        tail = self._leaf(count - 2)
+        root = self._pop_tail(self.shift, self.root) or ()
+        shift = self.shift
+        if shift > BITS and len(root) == 1:
+            root, shift = root[0], shift - BITS
+        return PersistentVector(count - 1, shift, root, tail)
+
+    def __iter__(self):
+        for start in range(0, self._tail_offset(), WIDTH):
+            for value in self._leaf(start):
+                yield value
+        for value in self.tail:
+            yield value
+
+    def __len__(self):
+        return self.count
@@ -4,8 +4,11 @@ with a parser for lisp expressions.
 In addition to the types defined in this file, some data types in lisp are
 represented by their corresponding type in Python:
     number:       int or float
-    symbol:       string
+    symbol:       Symbol (see lisp_tokens)
+    string:       String (see lisp_tokens)
     boolean:      bool
+    array:        numpy.ndarray, or array.array without NumPy (see lisp_arrays)
+    pmap, pvec:   PersistentMap, PersistentVector (see lisp_persistent)
     unspecified:  None
 
 The __repr__ method of a lisp value will return a Python expression that
@@ -19,14 +22,46 @@ from __future__ import print_function  # Python 2 compatibility
 import numbers
 
 from ucb import main, trace, interact
-from lisp_tokens import tokenize_lines, DELIMITERS
+from lisp_arrays import is_array
+from lisp_persistent import PersistentMap, PersistentVector
+from lisp_tokens import tokenize_lines, DELIMITERS, Symbol, String
 from buffer import Buffer, InputReader, LineReader
-import lisp_interpreter
+
+class lispError(Exception):
+    """Exception indicating an error in a lisp program."""
 
 # Pairs and lisp lists
+# A Pair that starts a well-formed list whose length is a multiple of
+# MARK_SPACING may hold a _Mark, which caches that length along with the
+# epoch in which it was found. Other Pairs hold None, so the cache costs one
+# slot per Pair and one _Mark per MARK_SPACING Pairs. The length of a list is
+# found by walking it to the nearest current mark, which takes fewer than
+# MARK_SPACING steps once the list has been measured, and marks are added
+# along the way. Changing the second of a Pair with set_second can change
+# the length of any list that contains it, so it starts a new epoch, in
+# which every mark is out of date and is replaced when it is next needed.
+#
+# Marks also cache the structural hash of their lists. Any mutation of a
+# Pair or vector can change the hash of a list that contains it, so
+# mutations start a new version, and a hash is only reused in the version
+# in which it was found.
+
+_epoch = 0  # The current epoch
+_version = 0  # The current version
+MARK_SPACING = 32
+
+class _Mark(object):
+    """The LENGTH of a list, found in EPOCH, and its HASH, found in VERSION
+    (None if it has not been found)."""
+    __slots__ = ('epoch', 'length', 'version', 'hash')
+
+    def __init__(self, epoch, length):
+        self.epoch, self.length = epoch, length
+        self.version = self.hash = None
 
 class Pair(object):
-    """A pair has two instance attributes: first and second. Second must be a Pair or nil
+    """A pair has two instance attributes: first and second. Second must be a
+    Pair, nil, or a value of a type in CDR_TYPES, such as a promise.
 
     >>> s = Pair(1, Pair(2, nil))
     >>> s
@@ -35,13 +70,47 @@ class Pair(object):
     (1 2)
     >>> print(s.map(lambda x: x+4))
     (5 6)
+    >>> len(s), s.list_length()
+    (2, 2)
+    >>> set_second(s.second, s.second.second.map(abs))
+    >>> len(s)
+    2
+    >>> hash(s) == hash(Pair(1, Pair(2, nil)))
+    True
     """
+    __slots__ = ('first', 'second', '_mark')
+
     def __init__(self, first, second):
-        from lisp_builtins import lisp_valid_cdrp, lispError
-        if not (second is nil or isinstance(second, Pair) or type(second).__name__ == 'Promise'):
+        if second is not nil and type(second) not in CDR_TYPES:
             raise lispError("cdr can only be a pair, nil, or a promise but was {}".format(second))
         self.first = first
         self.second = second
+        self._mark = None
+
+    def list_length(self):
+        """Return the length of SELF if it is a well-formed list, or None.
+        Assumes no cycles."""
+        pairs, pair = [], self
+        while True:
+            mark = pair._mark
+            if mark is not None and mark.epoch == _epoch:
+                length = mark.length
+                break
+            pairs.append(pair)
+            second = pair.second
+            if not isinstance(second, Pair):
+                length = 0 if second is nil else None
+                break
+            pair = second
+        if length is None:
+            return None
+        for pair in reversed(pairs):
+            length += 1
+            if length % MARK_SPACING == 0:
+                pair._mark = _Mark(_epoch, length)
+            elif pair._mark is not None:
+                pair._mark = None  # Out of date
+        return length
 
     def __repr__(self):
         return 'Pair({0}, {1})'.format(repr(self.first), repr(self.second))
@@ -57,26 +126,158 @@ class Pair(object):
         return s + ')'
 
     def __len__(self):
-        n, second = 1, self.second
-        while isinstance(second, Pair):
-            n += 1
-            second = second.second
-        if second is not nil:
+        n = self.list_length()
+        if n is None:
             raise TypeError('length attempted on improper list')
         return n
 
     def __eq__(self, p):
-        if not isinstance(p, Pair):
-            return False
-        return self.first == p.first and self.second == p.second
+        s = self
+        while isinstance(s, Pair):
+            if not isinstance(p, Pair) or s.first != p.first:
+                return False
+            s, p = s.second, p.second
+        return s == p
+
+    def __hash__(self):
+        self.list_length()  # Mark the list, so that its hashes are cached
+        pairs, pair = [], self
+        while True:
+            mark = pair._mark
+            if mark is not None and mark.version == _version:
+                value = mark.hash
+                break
+            pairs.append(pair)
+            second = pair.second
+            if not isinstance(second, Pair):
+                value = lisp_hash(second)
+                break
+            pair = second
+        for pair in reversed(pairs):
+            value = hash((lisp_hash(pair.first), value))
+            mark = pair._mark
+            if mark is not None:
+                mark.version, mark.hash = _version, value
+        return value
 
     def map(self, fn):
-        """Return a lisp list after mapping Python function FN to SELF."""
-        mapped = fn(self.first)
-        if self.second is nil or isinstance(self.second, Pair):
-            return Pair(mapped, self.second.map(fn))
-        else:
-            raise TypeError('ill-formed list (cdr is a promise)')
+        """Return a lisp list after mapping Python function FN to SELF.
+
+        >>> s = pair_from_items(list(range(5000)), nil)
+        >>> s.map(lambda x: x) == s, s.map(lambda x: -x) == s
+        (True, False)
+        """
+        items, pair = [], self
+        while True:
+            items.append(fn(pair.first))
+            pair = pair.second
+            if pair is nil:
+                return pair_from_items(items, nil)
+            if not isinstance(pair, Pair):
+                raise TypeError('ill-formed list (cdr is a promise)')
+
+    def __reduce__(self):
+        # Pickle the elements of a list together rather than each Pair
+        # inside the next, which would exhaust the Python stack for a long
+        # list.
+        items, second = [self.first], self.second
+        while isinstance(second, Pair):
+            items.append(second.first)
+            second = second.second
+        return pair_from_items, (items, second)
+
+# The types besides Pair and nil that may be the second of a Pair. The
+# interpreter adds the type of promises.
+CDR_TYPES = {Pair}
+
+def make_pair(first, second, new=object.__new__):
+    """Return Pair(FIRST, SECOND) without checking SECOND. Internal callers
+    use make_pair only when SECOND is known to be a Pair or nil.
+
+    >>> make_pair(1, make_pair(2, nil))
+    Pair(1, Pair(2, nil))
+    """
+    pair = new(Pair)
+    pair.first = first
+    pair.second = second
+    pair._mark = None
+    return pair
+
+def pair_from_items(items, second):
+    """Return a list of the elements of the Python list ITEMS that ends in
+    SECOND.
+
+    >>> pair_from_items([1, 2], nil)
+    Pair(1, Pair(2, nil))
+    """
+    for item in reversed(items):
+        second = Pair(item, second)
+    return second
+
+def set_first(pair, first):
+    """Change the first of PAIR to FIRST, which starts a new version."""
+    global _version
+    pair.first = first
+    _version += 1
+
+def set_second(pair, second):
+    """Change the second of PAIR to SECOND, which starts a new epoch and a
+    new version."""
+    global _epoch, _version
+    pair.second = second
+    _epoch += 1
+    _version += 1
+
+# Vectors
+class Vector(list):
+    """A lisp vector, a Python list of its elements. Only Vectors are lisp
+    vectors; other Python lists, such as those that builtins use for their
+    own work, are not.
+
+    >>> v = Vector([1, Pair(2, nil)])
+    >>> v
+    Vector([1, Pair(2, nil)])
+    >>> print(v)
+    #(1 (2))
+    >>> v == [1, Pair(2, nil)], type(v[:1]) is Vector
+    (True, False)
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'Vector({0})'.format(list.__repr__(self))
+
+    def __str__(self):
+        return repl_str(self)
+
+def mutated():
+    """Start a new version after a vector or array has been changed."""
+    global _version
+    _version += 1
+
+def lisp_hash(val):
+    """Return a hash of VAL that is the same for all values that are
+    equal?, hashing lists, vectors, and arrays by their elements.
+
+    >>> lisp_hash(Pair(1, nil)) == lisp_hash(Pair(1.0, nil))
+    True
+    >>> v, w = Vector([1, Vector([2])]), Vector([1.0, Vector([2.0])])
+    >>> lisp_hash(v) == lisp_hash(w)
+    True
+    """
+    if type(val) is Vector:
+        return hash(tuple(lisp_hash(v) for v in val))
+    if is_array(val):
+        return hash(tuple(float(x) for x in val))
+    if isinstance(val, PersistentVector):
+        return hash(tuple(lisp_hash(v) for v in val))
+    if isinstance(val, PersistentMap):
+        return hash(frozenset((lisp_hash(k), lisp_hash(v))
+                              for k, v in val.items()))
+    try:
+        return hash(val)
+    except TypeError:
+        return id(val)
 
 class nil(object):
     """The empty list"""
@@ -93,14 +294,17 @@ class nil(object):
     def map(self, fn):
         return self
 
+    def __reduce__(self):
+        return 'nil'  # Unpickles as the one instance
+
 nil = nil() # Assignment hides the nil class; there is only one instance
 
 
 # lisp list parser
 # Quotation markers
-quotes = {"'":  'quote',
-          '`':  'quasiquote',
-          ',':  'unquote'}
+quotes = {"'":  Symbol('quote'),
+          '`':  Symbol('quasiquote'),
+          ',':  Symbol('unquote')}
 
 def lisp_read(src):
     """Read the next expression from SRC, a Buffer of tokens.
@@ -113,21 +317,12 @@ def lisp_read(src):
     True
     >>> lisp_read(Buffer(tokenize_lines(['(+ 1 2)'])))
     Pair('+', Pair(1, Pair(2, nil)))
+    >>> lisp_read(Buffer(tokenize_lines(['#(1 (2))'])))
+    Vector([1, Pair(2, nil)])
+    >>> len(lisp_read(Buffer(tokenize_lines(['(' * 100000 + ')' * 100000]))))
+    1
     """
-    if src.current() is None:
-        raise EOFError
-    val = src.remove_front() # Get the first token
-    if val == 'nil':
-        return nil
-    elif val == '(':
-        return read_tail(src)
-    elif val in quotes:
-        result =quotes[val]
-        return Pair(result, Pair(lisp_read(src), nil))
-    elif val not in DELIMITERS:
-        return val
-    else:
-        raise SyntaxError('unexpected token: {0}'.format(val))
+    return _read(src, [])
 
 def read_tail(src):
     """Return the remainder of a list in SRC, starting before an element or ).
@@ -137,17 +332,48 @@ def read_tail(src):
     >>> read_tail(Buffer(tokenize_lines(['2 3)'])))
     Pair(2, Pair(3, nil))
     """
-    try:
-        if src.current() is None:
-            raise SyntaxError('unexpected end of file')
-        elif src.current() == ')':
-            src.remove_front()
-            return nil
-        else:
-            return Pair(lisp_read(src) , read_tail(src))
-
-    except EOFError:
-        raise SyntaxError('unexpected end of file')
+    return _read(src, [('(', [])])
+
+def _read(src, stack):
+    """Read the rest of an expression from SRC. STACK holds a pair (marker,
+    elements) for each unfinished list, vector or quotation around the
+    expression, innermost last. The marker of a list or vector is the token
+    that opens it, and its elements are those read so far. The marker of a
+    quotation is the symbol it stands for, and its elements are None."""
+    lists = len(stack)  # The number of unfinished lists and vectors
+    while True:
+        try:
+            val = src.current()  # Reading input may raise EOFError
+            if val is None:
+                raise EOFError
+        except EOFError:
+            if lists:
+                raise SyntaxError('unexpected end of file')
+            raise
+        src.remove_front()
+        if val == ')' and lists and stack[-1][1] is not None:
+            marker, elements = stack.pop()
+            lists -= 1
+            if marker == '(':
+                val = pair_from_items(elements, nil)
+            else:
+                val = Vector(elements)
+        elif val == 'nil':
+            val = nil
+        elif val == '(' or val == '#(':
+            stack.append((val, []))
+            lists += 1
+            continue
+        elif val in quotes:
+            stack.append((quotes[val], None))
+            continue
+        elif val in DELIMITERS:
+            raise SyntaxError('unexpected token: {0}'.format(val))
+        while stack and stack[-1][1] is None:
+            val = make_pair(stack.pop()[0], make_pair(val, nil))
+        if not stack:
+            return val
+        stack[-1][1].append(val)
 
 # Convenence methods
 def buffer_input(prompt='scm> '):
@@ -155,7 +381,8 @@ def buffer_input(prompt='scm> '):
     return Buffer(tokenize_lines(InputReader(prompt)))
 
 def buffer_lines(lines, prompt='scm> ', show_prompt=False):
-    """Return a Buffer instance iterating through LINES."""
+    """Return a Buffer instance iterating through LINES, an iterator over
+    lines that later calls continue to read from."""
     if show_prompt:
         input_lines = lines
     else:
@@ -176,6 +403,15 @@ def repl_str(val):
         return "undefined"
     if isinstance(val, numbers.Number) and not isinstance(val, numbers.Integral):
         return repr(val)  # Python 2 compatibility
+    if type(val) is Vector:
+        return '#(' + ' '.join(repl_str(v) for v in val) + ')'
+    if is_array(val):
+        return '#[array' + ''.join(' ' + repr(float(x)) for x in val) + ']'
+    if isinstance(val, PersistentVector):
+        return '#[pvec' + ''.join(' ' + repl_str(v) for v in val) + ']'
+    if isinstance(val, PersistentMap):
+        return '#[pmap' + ''.join(' {0} {1}'.format(repl_str(k), repl_str(v))
+                                  for k, v in val.items()) + ']'
     return str(val)
 
 # Interactive loop
@@ -4,20 +4,24 @@ of tokens.  A token may be:
 
   * A number (represented as an int or float)
   * A boolean (represented as a bool)
-  * A symbol (represented as a string)
-  * A delimiter, including parentheses, dots, and single quotes
+  * A symbol (represented as a Symbol)
+  * A string (represented as a String)
+  * A delimiter, including parentheses, dots, single quotes, and the #( that
+    begins a vector
 
-This file also includes some features of lisp that have not been addressed
-in the course, such as lisp strings.
+This file also defines the Symbol and String types of lisp values, which
+tokenize_line produces.
 """
 
 from __future__ import print_function  # Python 2 compatibility
 
 from ucb import main
+import ast
 import itertools
+import json
+import re
 import string
 import sys
-import tokenize
 
 _NUMERAL_STARTS = set(string.digits) | set('+-.')
 _SYMBOL_CHARS = (set('!$%&*/:<=>?@^_~') | set(string.ascii_lowercase) |
@@ -26,7 +30,49 @@ _STRING_DELIMS = set('"')
 _WHITESPACE = set(' \t\n\r')
 _SINGLE_CHAR_TOKENS = set("()[]'`")
 _TOKEN_END = _WHITESPACE | _SINGLE_CHAR_TOKENS | _STRING_DELIMS | {',', ',@'}
-DELIMITERS = _SINGLE_CHAR_TOKENS | {'.', ',', ',@'}
+DELIMITERS = _SINGLE_CHAR_TOKENS | {'.', ',', ',@', '#('}
+
+class Symbol(str):
+    """A lisp symbol. Symbols are interned: there is only one Symbol of each
+    name, so symbols are the same exactly when they are identical.
+
+    >>> Symbol('abc') is Symbol('ab' + 'c')
+    True
+    """
+    __slots__ = ()
+    table = {}  # All symbols, by name
+
+    def __new__(cls, name):
+        symbol = cls.table.get(name)
+        if symbol is None:
+            symbol = cls.table[name] = str.__new__(cls, name)
+        return symbol
+
+class String(object):
+    """A lisp string, which holds its decoded TEXT.
+
+    >>> s = String('say "hi"')
+    >>> print(s)
+    "say \\"hi\\""
+    >>> s == String('say "hi"'), s == 'say "hi"'
+    (True, False)
+    """
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+    def __eq__(self, other):
+        return isinstance(other, String) and self.text == other.text
+
+    def __hash__(self):
+        return hash(self.text)
+
+    def __repr__(self):
+        return 'String({0})'.format(repr(self.text))
+
+    def __str__(self):
+        return json.dumps(self.text, ensure_ascii=False)
 
 def valid_symbol(s):
     """Returns whether s is a well-formed symbol."""
@@ -37,87 +83,131 @@ def valid_symbol(s):
             return False
     return True
 
-def next_candidate_token(line, k):
-    """A tuple (tok, k'), where tok is the next substring of line at or
-    after position k that could be a token (assuming it passes a validity
-    check), and k' is the position in line following that token.  Returns
-    (None, len(line)) when there are no more tokens."""
-    while k < len(line):
-        c = line[k]
-        if c == ';':
-            return None, len(line)
-        elif c in _WHITESPACE:
-            k += 1
-        elif c in _SINGLE_CHAR_TOKENS:
-            if c == ']': c = ')'
-            if c == '[': c = '('
-            return c, k+1
-        elif c == '#':  # Boolean values #t and #f
-            return line[k:k+2], min(k+2, len(line))
-        elif c == ',': # Unquote; check for @
-            if k+1 < len(line) and line[k+1] == '@':
-                return ',@', k+2
-            return c, k+1
-        elif c in _STRING_DELIMS:
-            if k+1 < len(line) and line[k+1] == c: # No triple quotes in lisp
-                return c+c, k+2
-            line_bytes = (bytes(line[k:], encoding='utf-8'),)
-            gen = tokenize.tokenize(iter(line_bytes).__next__)
-            next(gen) # Throw away encoding token
-            token = next(gen)
-            if token.type != tokenize.STRING:
-                raise ValueError("invalid string: {0}".format(token.string))
-            return token.string, token.end[1]+k
-        else:
-            j = k
-            while j < len(line) and line[j] not in _TOKEN_END:
-                j += 1
-            return line[k:j], min(j, len(line))
-    return None, len(line)
+# The tokens of a line are the strings that _TOKEN finds in it, after
+# whitespace. A string that is not closed on its line and a comment each
+# extend to the end of the line. Each kind of token can be told by its first
+# character, except that an open string is not a whole match of _STRING.
+_TOKEN = re.compile(r"""[ \t\n\r]*(
+    [()'`\[\]] | ,@? | \#[\s\S]?  # Delimiters, and booleans such as #t
+  | "[^\n"\\]*(?:\\.[^\n"\\]*)*" | "[\s\S]*  # Strings, closed or open
+  | ;[\s\S]*  # A comment
+  | [^ \t\n\r()\[\]'`",]+  # A numeral or symbol
+)""", re.VERBOSE)
+_STRING = re.compile(r'"[^\n"\\]*(?:\\.[^\n"\\]*)*"')
 
-def tokenize_line(line):
-    """The list of lisp tokens on line.  Excludes comments and whitespace."""
-    result = []
-    text, i = next_candidate_token(line, 0)
-    while text is not None:
-        if text in DELIMITERS:
-            result.append(text)
-        elif text == '#t' or text.lower() == 'true':
-            result.append(True)
-        elif text == '#f' or text.lower() == 'false':
-            result.append(False)
-        elif text == 'nil':
-            result.append(text)
-        elif text[0] in _SYMBOL_CHARS:
-            number = False
-            if text[0] in _NUMERAL_STARTS:
+# A string that may span lines, which starts a text that is an open string
+_LONG_STRING = re.compile(r'"(?:[^"\\]|\\[\s\S])*"')
+
+# The tokens of delimiters and of the symbols that have been read, by the
+# text that they are read from
+_KNOWN = {d: d for d in DELIMITERS}
+_KNOWN.update({'[': '(', ']': ')', '#t': True, '#f': False})
+
+def _string(text):
+    """Return the String written as the Python string literal TEXT, in which
+    a newline that is not escaped stands for itself."""
+    if '\\' not in text and '\r' not in text and '\n' not in text:
+        return String(text[1:-1])
+    if '\n' in text:
+        text = re.sub(r'\\[\s\S]|\n',
+                      lambda m: '\\n' if m.group() == '\n' else m.group(),
+                      text)
+    return String(ast.literal_eval(text))
+
+def _atom(text):
+    """Return the token written as TEXT, which is not a string, or None if
+    it is not a valid token."""
+    if text in DELIMITERS:
+        return text
+    elif text == '#t' or text.lower() == 'true':
+        return True
+    elif text == '#f' or text.lower() == 'false':
+        return False
+    elif text == 'nil':
+        return text
+    elif text[0] in _SYMBOL_CHARS:
+        if text[0] in _NUMERAL_STARTS:
+            try:
+                return int(text)
+            except ValueError:
                 try:
-                    result.append(int(text))
-                    number = True
+                    return float(text)
                 except ValueError:
-                    try:
-                        result.append(float(text))
-                        number = True
-                    except ValueError:
-                        pass
-            if not number:
-                if valid_symbol(text):
-                    result.append(text.lower())
-                else:
-                    raise ValueError("invalid numeral or symbol: {0}".format(text))
-        elif text[0] in _STRING_DELIMS:
-            result.append(text)
-        else:
-            print("warning: invalid token: {0}".format(text), file=sys.stderr)
-            print("    ", line, file=sys.stderr)
-            print(" " * (i+3), "^", file=sys.stderr)
-        text, i = next_candidate_token(line, i)
+                    pass
+        if valid_symbol(text):
+            return Symbol(text.lower())
+        raise ValueError("invalid numeral or symbol: {0}".format(text))
+    return None
+
+def _scan(line, result, k=0):
+    """Append to the list RESULT the lisp tokens of LINE from position K on.
+    Return the rest of LINE from the start of a string that is not closed on
+    it, or None."""
+    append, known = result.append, _KNOWN
+    for n, text in enumerate(_TOKEN.findall(line, k)):
+        token = known.get(text, _atom)
+        if token is _atom:
+            first = text[0]
+            if first == '"':
+                if _STRING.match(text) is None or len(text) == 1:
+                    return text
+                token = _string(text)
+            elif first == ';':
+                break
+            else:
+                token = _atom(text)
+                if token is None:
+                    i = list(_TOKEN.finditer(line, k))[n].end()
+                    print("warning: invalid token: {0}".format(text),
+                          file=sys.stderr)
+                    print("    ", line, file=sys.stderr)
+                    print(" " * (i+3), "^", file=sys.stderr)
+                    continue
+                if type(token) is not int and type(token) is not float:
+                    known[text] = token
+        append(token)
+    return None
+
+def tokenize_line(line):
+    """The list of lisp tokens on line.  Excludes comments and whitespace.
+
+    >>> tokenize_line('(f [x] #(1.5 -2 "a;b" #t) ,@y) ; comment')
+    ... # doctest: +NORMALIZE_WHITESPACE
+    ['(', 'f', '(', 'x', ')', '#(', 1.5, -2, String('a;b'), True, ')',
+     ',@', 'y', ')']
+    """
+    result = []
+    rest = _scan(line, result)
+    if rest is not None:
+        raise ValueError("invalid string: {0}".format(rest))
     return result
 
 def tokenize_lines(input):
     """An iterator over lists of tokens, one for each line of the iterable
-    input sequence."""
-    return (tokenize_line(line) for line in input)
+    input sequence. A string that is not closed on one line continues on the
+    next, and its tokens are listed with those of the line on which it ends.
+
+    >>> list(tokenize_lines(['(display "one', 'two")']))
+    [['(', 'display'], [String('one\\ntwo'), ')']]
+    """
+    rest = None  # The start of a string that continues on the next line
+    for line in input:
+        result = []
+        if rest is not None:
+            if not rest.endswith('\n'):
+                rest += '\n'
+            line = rest + line
+            match = _LONG_STRING.match(line)
+            if match is None:
+                rest = line
+                continue
+            result.append(_string(match.group()))
+            rest = _scan(line, result, match.end())
+        else:
+            rest = _scan(line, result)
+        yield result
+    if rest is not None:
+        raise ValueError("invalid string: {0}".format(rest))
 
 def count_tokens(input):
     """Count the number of non-delimiter tokens in input."""
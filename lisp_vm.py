@@ -0,0 +1,555 @@
+"""A bytecode compiler and virtual machine for lisp.
+
+The compiler translates a lisp expression into a Code object: a flat list of
+instructions for a stack machine. The run function executes Code in a single
+loop. A call to a compiled procedure pushes the caller's position onto a list
+of return points instead of recursing in Python, so the depth of recursion in
+a lisp program is limited by memory and MAX_DEPTH rather than by the Python
+stack. Calls made by builtins, such as apply and map, still recurse in Python.
+
+Compiled code shares its frames, scopes, and procedures with lisp_interpreter,
+so builtins such as map and apply can call compiled procedures, and compiled
+code can call procedures created by lisp_eval.
+"""
+
+from __future__ import print_function  # Python 2 compatibility
+
+from lisp_interpreter import *
+
+# Opcodes
+# Each instruction is a pair (OPCODE, ARGUMENT).
+LOAD_CONST = 0          # Push ARGUMENT
+LOAD_LOCAL = 1          # Push slot ARGUMENT[0] of the current frame
+LOAD_SLOT = 2           # Push slot ARGUMENT[1] of the frame ARGUMENT[0] up
+LOAD_GLOBAL = 3         # Push a global through the InlineCache ARGUMENT
+LOAD_NAME = 4           # Look up ARGUMENT[1] from frame ARGUMENT[0] up
+DEFINE_SLOT = 5         # Pop a value into slot ARGUMENT[0]; push ARGUMENT[1]
+DEFINE_NAME = 6         # Pop a value and define ARGUMENT; push ARGUMENT
+POP = 7                 # Discard the top of the stack
+JUMP = 8                # Continue at ARGUMENT
+POP_JUMP_IF_FALSE = 9   # Pop; continue at ARGUMENT if the value is false
+JUMP_IF_FALSE_OR_POP = 10  # Continue at ARGUMENT if the top is false, or pop
+JUMP_IF_TRUE_OR_POP = 11   # Continue at ARGUMENT if the top is true, or pop
+CHECK_PROCEDURE = 12    # Check the operator on top; run its expansion if a
+                        # macro, expanding only when the macro changes
+CALL = 13               # Call with ARGUMENT operands; push the result
+TAIL_CALL = 14          # Call with ARGUMENT operands; return the result
+RETURN = 15             # Return the top of the stack to the caller
+MAKE_LAMBDA = 16        # Push a VMProcedure for the Template ARGUMENT
+PUSH_FRAME = 17         # Pop ARGUMENT[1] values into a frame with layout
+POP_FRAME = 18          # Return to the parent of the current frame
+SPECIAL_FORM = 19       # Push the value of a special form without a compiler
+RAISE = 20              # Raise a lispError like ARGUMENT
+MAKE_MU = 21            # Push a VMMuProcedure for the Template ARGUMENT
+
+OPCODE_NAMES = ['LOAD_CONST', 'LOAD_LOCAL', 'LOAD_SLOT', 'LOAD_GLOBAL',
+                'LOAD_NAME', 'DEFINE_SLOT', 'DEFINE_NAME', 'POP', 'JUMP',
+                'POP_JUMP_IF_FALSE', 'JUMP_IF_FALSE_OR_POP',
+                'JUMP_IF_TRUE_OR_POP', 'CHECK_PROCEDURE', 'CALL', 'TAIL_CALL',
+                'RETURN', 'MAKE_LAMBDA', 'PUSH_FRAME', 'POP_FRAME',
+                'SPECIAL_FORM', 'RAISE', 'MAKE_MU']
+
+# The largest number of calls that may wait for a return at once. Exceeding it
+# raises a RecursionError, which the read-eval-print loop reports.
+MAX_DEPTH = 100000
+
+
+class Code(object):
+    """A list of INSTRUCTIONS, each a pair (OPCODE, ARGUMENT)."""
+
+    def __init__(self):
+        self.instructions = []
+
+    def emit(self, opcode, argument=None):
+        """Append an instruction and return its index."""
+        self.instructions.append((opcode, argument))
+        return len(self.instructions) - 1
+
+    def patch(self, index, argument):
+        """Replace the argument of the instruction at INDEX."""
+        self.instructions[index] = (self.instructions[index][0], argument)
+
+    def here(self):
+        """The index of the next instruction to be emitted."""
+        return len(self.instructions)
+
+    def __str__(self):
+        lines = []
+        for i, (opcode, argument) in enumerate(self.instructions):
+            if isinstance(argument, tuple):
+                argument = ' '.join(str(a) for a in argument)
+            lines.append('{0:4} {1:<20} {2}'.format(
+                i, OPCODE_NAMES[opcode], '' if argument is None else argument))
+        return '\n'.join(lines)
+
+class Template(object):
+    """The compiled form of a lambda expression with FORMALS and BODY: the
+    LAYOUT of its frames and the CODE of its body."""
+
+    def __init__(self, formals, body, layout, code):
+        self.formals = formals
+        self.body = body
+        self.layout = layout
+        self.code = code
+        self.arity = len(formals) if isinstance(formals, Pair) else 0
+        self.unassigned = [UNASSIGNED] * (len(layout) - self.arity)
+
+class VMProcedure(LambdaProcedure):
+    """A LambdaProcedure whose body is compiled to bytecode."""
+
+    def __init__(self, template, env):
+        self.formals = template.formals
+        self.body = template.body
+        self.env = env
+        self.layout = template.layout
+        self.arity = template.arity
+        self.template = template
+
+    def analyzed(self, env):
+        """Run my code in ENV, a frame made by make_call_frame. This is how
+        execute applies me when I am called from outside the machine."""
+        return run(self.template.code, env)
+
+class VMMuProcedure(MuProcedure):
+    """A MuProcedure whose body is compiled to bytecode."""
+
+    def __init__(self, template):
+        self.formals = template.formals
+        self.body = template.body
+        self.layout = template.layout
+        self.arity = template.arity
+        self.template = template
+
+    def analyzed(self, env):
+        """Run my code in ENV, a frame made by make_call_frame."""
+        return run(self.template.code, env)
+
+# Compiler
+# Each compile_xxx function appends the code for an expression to CODE. If
+# TAIL, the code returns the value of the expression from the procedure;
+# otherwise it leaves that value on the stack. As with analysis, errors in
+# the syntax of a form are raised when that form is evaluated.
+
+def compile_expr(expr, scope, code, tail=False):
+    """Append code for lisp expression EXPR in SCOPE to CODE."""
+    if lisp_symbolp(expr):
+        compile_symbol(expr, scope, code)
+    elif self_evaluating(expr):
+        code.emit(LOAD_CONST, expr)
+    elif not lisp_listp(expr):
+        code.emit(RAISE, lispError('malformed list: {0}'.format(repl_str(expr))))
+        return
+    elif lisp_symbolp(expr.first) and expr.first in SPECIAL_FORMS:
+        first, rest = expr.first, expr.second
+        if first not in COMPILERS:
+            code.emit(SPECIAL_FORM, (SPECIAL_FORMS[first], rest))
+        else:
+            start = code.here()
+            try:
+                COMPILERS[first](rest, scope, code, tail)
+                return
+            except lispError as err:
+                del code.instructions[start:]
+                code.emit(RAISE, err)
+                return
+    else:
+        compile_combination(expr.first, expr.second, scope, code, tail)
+        return
+    if tail:
+        code.emit(RETURN)
+
+def compile_symbol(symbol, scope, code):
+    """Append code for a reference to SYMBOL in SCOPE to CODE."""
+    kind, where, slot = resolve(symbol, scope)
+    if kind == 'slot' and where == 0:
+        code.emit(LOAD_LOCAL, (slot, symbol))
+    elif kind == 'slot':
+        code.emit(LOAD_SLOT, (where, slot, symbol))
+    elif kind == 'global':
+        code.emit(LOAD_GLOBAL, InlineCache(where, symbol))
+    else:
+        code.emit(LOAD_NAME, (where, symbol))
+
+def compile_body(formals, body, scope, dynamic=False):
+    """Return a Template for a procedure with FORMALS and BODY, whose scope
+    has parent SCOPE."""
+    layout = body_layout(formals, body)
+    code = Code()
+    compile_sequence(body, Scope(layout, scope, dynamic), code, True)
+    return Template(formals, body, layout, code)
+
+def compile_sequence(expressions, scope, code, tail):
+    """Append code for the lisp list EXPRESSIONS, evaluated in order for the
+    value of the last, to CODE."""
+    if expressions is nil:
+        code.emit(LOAD_CONST, None)
+        if tail:
+            code.emit(RETURN)
+        return
+    while expressions.second is not nil:
+        compile_expr(expressions.first, scope, code)
+        code.emit(POP)
+        expressions = expressions.second
+    compile_expr(expressions.first, scope, code, tail)
+
+def compile_combination(operator, operands, scope, code, tail):
+    """Append code for a call of OPERATOR on the lisp list OPERANDS."""
+    compile_expr(operator, scope, code)
+    check = code.emit(CHECK_PROCEDURE)
+    n = 0
+    expressions = operands
+    while expressions is not nil:
+        compile_expr(expressions.first, scope, code)
+        expressions, n = expressions.second, n + 1
+    code.emit(TAIL_CALL if tail else CALL, n)
+    code.patch(check, (operands, scope, tail, code.here(), [None, None]))
+
+def compile_define_form(expressions, scope, code, tail):
+    """Append code for a define form."""
+    check_form(expressions, 2)
+    target = expressions.first
+    if lisp_symbolp(target):
+        check_form(expressions, 2, 2)
+        compile_expr(expressions.second.first, scope, code)
+    elif isinstance(target, Pair) and lisp_symbolp(target.first):
+        compile_lambda_form(Pair(target.second, expressions.second), scope,
+                            code, False)
+        target = target.first
+    else:
+        bad_target = target.first if isinstance(target, Pair) else target
+        raise lispError('non-symbol: {0}'.format(bad_target))
+    if isinstance(scope, Scope) and target in scope.layout:
+        code.emit(DEFINE_SLOT, (scope.layout[target], target))
+    else:
+        code.emit(DEFINE_NAME, target)
+    if tail:
+        code.emit(RETURN)
+
+def compile_quote_form(expressions, scope, code, tail):
+    """Append code for a quote form."""
+    check_form(expressions, 1, 1)
+    code.emit(LOAD_CONST, expressions.first)
+    if tail:
+        code.emit(RETURN)
+
+def compile_begin_form(expressions, scope, code, tail):
+    """Append code for a begin form."""
+    check_form(expressions, 1)
+    compile_sequence(expressions, scope, code, tail)
+
+def compile_lambda_form(expressions, scope, code, tail):
+    """Append code for a lambda form."""
+    check_form(expressions, 2)
+    formals = expressions.first
+    check_formals(formals)
+    code.emit(MAKE_LAMBDA, compile_body(formals, expressions.second, scope))
+    if tail:
+        code.emit(RETURN)
+
+def compile_mu_form(expressions, scope, code, tail):
+    """Append code for a mu form."""
+    check_form(expressions, 2)
+    formals = expressions.first
+    check_formals(formals)
+    code.emit(MAKE_MU, compile_body(formals, expressions.second, None, True))
+    if tail:
+        code.emit(RETURN)
+
+def compile_if_form(expressions, scope, code, tail):
+    """Append code for an if form."""
+    check_form(expressions, 2, 3)
+    compile_expr(expressions.first, scope, code)
+    if_false = code.emit(POP_JUMP_IF_FALSE)
+    compile_expr(expressions.second.first, scope, code, tail)
+    if not tail:
+        end = code.emit(JUMP)
+    code.patch(if_false, code.here())
+    if len(expressions) == 3:
+        compile_expr(expressions.second.second.first, scope, code, tail)
+    else:
+        code.emit(LOAD_CONST, None)
+        if tail:
+            code.emit(RETURN)
+    if not tail:
+        code.patch(end, code.here())
+
+def compile_and_form(expressions, scope, code, tail):
+    """Append code for a (short-circuited) and form."""
+    compile_junction(expressions, True, JUMP_IF_FALSE_OR_POP, scope, code, tail)
+
+def compile_or_form(expressions, scope, code, tail):
+    """Append code for a (short-circuited) or form."""
+    compile_junction(expressions, False, JUMP_IF_TRUE_OR_POP, scope, code, tail)
+
+def compile_junction(expressions, empty, opcode, scope, code, tail):
+    """Append code for an and or or form, which has the value EMPTY when
+    it has no operands and stops early at an OPCODE jump."""
+    if expressions is nil:
+        code.emit(LOAD_CONST, empty)
+        if tail:
+            code.emit(RETURN)
+        return
+    jumps = []
+    while expressions.second is not nil:
+        compile_expr(expressions.first, scope, code)
+        jumps.append(code.emit(opcode))
+        expressions = expressions.second
+    compile_expr(expressions.first, scope, code, tail)
+    end = code.here()
+    if tail and jumps:
+        code.emit(RETURN)
+    for jump in jumps:
+        code.patch(jump, end)
+
+def compile_cond_form(expressions, scope, code, tail):
+    """Append code for a cond form. A clause whose syntax is bad raises its
+    error only if it is reached."""
+    ends, values = [], []
+    while expressions is not nil:
+        clause = expressions.first
+        try:
+            check_form(clause, 1)
+            if clause.first == 'else' and expressions.second != nil:
+                raise lispError('else must be last')
+        except lispError as err:
+            code.emit(RAISE, err)
+            return
+        if clause.first == 'else':
+            if clause.second is nil:
+                code.emit(LOAD_CONST, True)
+                if tail:
+                    code.emit(RETURN)
+            else:
+                compile_sequence(clause.second, scope, code, tail)
+            if not tail:
+                ends.append(code.emit(JUMP))
+        elif clause.second is nil:
+            compile_expr(clause.first, scope, code)
+            values.append(code.emit(JUMP_IF_TRUE_OR_POP))
+        else:
+            compile_expr(clause.first, scope, code)
+            if_false = code.emit(POP_JUMP_IF_FALSE)
+            compile_sequence(clause.second, scope, code, tail)
+            if not tail:
+                ends.append(code.emit(JUMP))
+            code.patch(if_false, code.here())
+        expressions = expressions.second
+    code.emit(LOAD_CONST, None)
+    if tail:
+        code.emit(RETURN)
+        if values:
+            code.emit(RETURN)
+    for jump in values:
+        code.patch(jump, code.here() - 1 if tail else code.here())
+    for jump in ends:
+        code.patch(jump, code.here())
+
+def compile_let_form(expressions, scope, code, tail):
+    """Append code for a let form. As in make_let_frame, a bad binding raises
+    its error after the values of the bindings before it are evaluated."""
+    check_form(expressions, 2)
+    bindings = expressions.first
+    if not lisp_listp(bindings):
+        raise lispError('bad bindings list in let form')
+    formals, layout, error = nil, {}, None
+    while bindings is not nil:
+        try:
+            check_form(bindings.first, 2, 2)
+        except lispError as err:
+            error = err
+            break
+        formals = Pair(bindings.first.first, formals)
+        compile_expr(bindings.first.second.first, scope, code)
+        if lisp_symbolp(bindings.first.first):
+            layout[bindings.first.first] = len(layout)
+        bindings = bindings.second
+    if error is None:
+        try:
+            check_formals(formals)
+        except lispError as err:
+            error = err
+    if error is not None:
+        code.emit(RAISE, error)
+        return
+    n = len(layout)
+    let_layout(layout, expressions.second)
+    code.emit(PUSH_FRAME, (layout, n, [UNASSIGNED] * (len(layout) - n)))
+    compile_sequence(expressions.second, Scope(layout, scope), code, tail)
+    if not tail:
+        code.emit(POP_FRAME)
+
+COMPILERS = {
+    'and': compile_and_form,
+    'begin': compile_begin_form,
+    'cond': compile_cond_form,
+    'define': compile_define_form,
+    'if': compile_if_form,
+    'lambda': compile_lambda_form,
+    'let': compile_let_form,
+    'mu': compile_mu_form,
+    'or': compile_or_form,
+    'quote': compile_quote_form,
+}
+
+# Virtual machine
+
+def run(code, env):
+    """Execute CODE, which was compiled in a tail position, in environment
+    ENV, and return its value."""
+    instructions = code.instructions
+    stack, returns, pc = [], [], 0
+    max_depth = MAX_DEPTH
+    while True:
+        opcode, argument = instructions[pc]
+        pc += 1
+        if opcode == LOAD_LOCAL:
+            value = env.values[argument[0]]
+            if value is UNASSIGNED:
+                value = env.parent.lookup(argument[1])
+            stack.append(value)
+        elif opcode == LOAD_GLOBAL:
+            if argument.version == argument.frame.version:
+                argument.hits += 1
+                stack.append(argument.value)
+            else:
+                stack.append(argument.refresh(env))
+        elif opcode == LOAD_CONST:
+            stack.append(argument)
+        elif opcode == CHECK_PROCEDURE:
+            procedure = stack[-1]
+            check_procedure(procedure)
+            if isinstance(procedure, MacroProcedure):
+                operands, scope, tail, end, expanded = argument
+                stack.pop()
+                if expanded[0] is not procedure:
+                    expansion = Code()
+                    compile_expr(procedure.apply_macro(operands, env), scope,
+                                 expansion, True)
+                    expanded[:] = procedure, expansion
+                if not tail:
+                    if len(returns) >= max_depth:
+                        raise RecursionError('maximum recursion depth exceeded')
+                    returns.append((instructions, end, env))
+                instructions, pc = expanded[1].instructions, 0
+        elif opcode == CALL or opcode == TAIL_CALL:
+            if argument:
+                args = stack[-argument:]
+                del stack[-argument:]
+            else:
+                args = []
+            procedure = stack.pop()
+            kind = type(procedure)
+            if kind is VMProcedure or kind is VMMuProcedure:
+                template = procedure.template
+                if len(args) != template.arity:
+                    raise lispError('Too many or too few vals are given.')
+                if template.unassigned:
+                    args.extend(template.unassigned)
+                if opcode == CALL:
+                    if len(returns) >= max_depth:
+                        raise RecursionError('maximum recursion depth exceeded')
+                    returns.append((instructions, pc, env))
+                parent = procedure.env if kind is VMProcedure else env
+                env = LocalFrame(template.layout, args, parent)
+                instructions, pc = template.code.instructions, 0
+                continue
+            value = lisp_call(procedure, args, env)
+            if opcode == CALL:
+                stack.append(value)
+            elif not returns:
+                return value
+            else:
+                instructions, pc, env = returns.pop()
+                stack.append(value)
+        elif opcode == RETURN:
+            if not returns:
+                return stack.pop()
+            value = stack.pop()
+            instructions, pc, env = returns.pop()
+            stack.append(value)
+        elif opcode == POP_JUMP_IF_FALSE:
+            if stack.pop() is False:
+                pc = argument
+        elif opcode == POP:
+            stack.pop()
+        elif opcode == JUMP:
+            pc = argument
+        elif opcode == JUMP_IF_FALSE_OR_POP:
+            if stack[-1] is False:
+                pc = argument
+            else:
+                stack.pop()
+        elif opcode == JUMP_IF_TRUE_OR_POP:
+            if stack[-1] is not False:
+                pc = argument
+            else:
+                stack.pop()
+        elif opcode == LOAD_SLOT:
+            frame = env
+            for _ in range(argument[0]):
+                frame = frame.parent
+            value = frame.values[argument[1]]
+            if value is UNASSIGNED:
+                value = frame.parent.lookup(argument[2])
+            stack.append(value)
+        elif opcode == LOAD_NAME:
+            frame = env
+            for _ in range(argument[0]):
+                frame = frame.parent
+            stack.append(frame.parent.lookup(argument[1]))
+        elif opcode == MAKE_LAMBDA:
+            stack.append(VMProcedure(argument, env))
+        elif opcode == MAKE_MU:
+            stack.append(VMMuProcedure(argument))
+        elif opcode == DEFINE_SLOT:
+            env.values[argument[0]] = stack.pop()
+            stack.append(argument[1])
+        elif opcode == DEFINE_NAME:
+            env.define(argument, stack.pop())
+            stack.append(argument)
+        elif opcode == PUSH_FRAME:
+            layout, n, unassigned = argument
+            if n:
+                values = stack[-n:]
+                del stack[-n:]
+            else:
+                values = []
+            env = LocalFrame(layout, values + unassigned, env)
+        elif opcode == POP_FRAME:
+            env = env.parent
+        elif opcode == SPECIAL_FORM:
+            do_form, expressions = argument
+            value = do_form(expressions, env)
+            if isinstance(value, Thunk):
+                value = lisp_eval(value.expr, value.env)
+            stack.append(value)
+        elif opcode == RAISE:
+            raise type(argument)(*argument.args)
+        else:
+            raise ValueError('unknown opcode: {0}'.format(opcode))
+
+def vm_eval(expr, env, _=None):  # Optional third argument is ignored
+    """Compile lisp expression EXPR and run it in environment ENV.
+
+    >>> env = create_vm_global_frame()
+    >>> vm_eval(read_line('((lambda (x) (* x x)) 12)'), env)
+    144
+    >>> vm_eval(read_line('(define (count n) (if (= n 0) 0 (+ 1 (count (- n 1)))))'), env)
+    'count'
+    >>> vm_eval(read_line('(count 20000)'), env)
+    20000
+    """
+    code = Code()
+    compile_expr(expr, env, code, True)
+    return run(code, env)
+
+def vm_load(*args):
+    """Load a lisp source file, as lisp_load does, with the VM."""
+    return lisp_load(*args, evaluate=vm_eval)
+
+def create_vm_global_frame():
+    """Return a global frame whose eval and load procedures use the VM."""
+    env = create_global_frame()
+    env.define('eval', eval_procedure(vm_eval))
+    env.define('load', BuiltinProcedure(vm_load, True, 'load'))
+    return env
@@ -27,6 +27,9 @@ even?
 (define a b c d)
 ; expect Error: too many operands in form
 
+(eval 'x 5)
+; expect Error: argument 1 of eval has wrong type (int)
+
 (define (a) b c d)
 ; expect a 
 
@@ -254,6 +257,175 @@ x
       6))
 ; expect 57
 
+;;; Strings
+
+(string? (rgb 1 0 0))
+; expect #t
+
+(rgb 1 0.5 0)
+; expect "#ff7f00"
+
+;;; Vectors
+
+(define v (make-vector 3 'a))
+; expect v
+(vector-set! v 1 '(1 2))
+v
+; expect #(a (1 2) a)
+
+(vector-ref v 1)
+; expect (1 2)
+
+(vector-length #(1 #(2) "three"))
+; expect 3
+
+(vector->list (vector-map + #(1 2 3) (list->vector '(10 20 30))))
+; expect (11 22 33)
+
+(equal? #(1 (2)) (vector 1 (list 2)))
+; expect #t
+
+;;; Numeric arrays
+
+(define a (list->array '(1 2 3)))
+; expect a
+(+ a 1)
+; expect #[array 2.0 3.0 4.0]
+
+(sqrt (* a a))
+; expect #[array 1.0 2.0 3.0]
+
+(dot a (array-slice (array 0 1 2 3) 1))
+; expect 14
+
+(sum (- a))
+; expect -6
+
+(mean a)
+; expect 2
+
+(log (expt 2 a) 2)
+; expect #[array 1.0 2.0 3.0]
+
+(* a 1e308 1e308)
+; expect Error: arithmetic error in *
+
+(/ a 0)
+; expect Error: arithmetic error in /
+
+(+ a (array 1 2))
+; expect Error: arrays of different lengths: 2, 3
+
+;;; Hash tables
+
+(define h (make-hash-table))
+(define k (list 1 2))
+(hash-table-set! h k 'a)
+(hash-table-set! h (vector 3) 'b)
+(hash-table-ref h '(1 2))
+; expect a
+
+(set-car! k 5)
+(hash-table-ref h (list 5 2) 'missing)
+; expect missing
+
+(hash-table-ref h #(3))
+; expect b
+
+(define e (make-hash-table eq?))
+(hash-table-set! e k 'c)
+(hash-table-set! e 1 'd)
+(list (hash-table-ref e k) (hash-table-ref e '(5 2) 'no) (hash-table-ref e 1))
+; expect (c no d)
+
+(hash-table-delete! e k)
+(hash-table-count e)
+; expect 1
+
+;;; Persistent maps and vectors
+
+(define v1 (pvec 1 2 3))
+(define v2 (pvec-assoc (pvec-conj v1 4) 0 'a))
+(list (pvec->list v1) (pvec->list v2) (pvec-nth v2 3))
+; expect ((1 2 3) (a 2 3 4) 4)
+
+v2
+; expect #[pvec a 2 3 4]
+
+(define m1 (pmap '(1 2) 'x))
+(define m2 (pmap-assoc m1 'y 2))
+(list (pmap-get m2 (list 1 2)) (pmap-get m1 'y #f) (pmap-count m2))
+; expect (x #f 2)
+
+(equal? (pmap-dissoc m2 'y) m1)
+; expect #t
+
+m1
+; expect #[pmap (1 2) x]
+
+;;; Records
+
+(define-record-type point (make-point x y) point?
+  (x point-x set-point-x!)
+  (y point-y))
+; expect point
+
+(define p (make-point 1 2))
+(set-point-x! p 10)
+(list (point-x p) (point-y p) (point? p) (point? '(1 2)))
+; expect (10 2 #t #f)
+
+p
+; expect #[point 10 2]
+
+(define (make-counter)
+  (define-record-type counter (new-counter n) counter? (n count set-count!))
+  (new-counter 0))
+(define c (make-counter))
+c
+; expect #[counter 0]
+
+;;; List library
+
+(define s (iota 5 1))
+(list (reverse s) (list-ref s 1) (list-tail s 3) (last s))
+; expect ((5 4 3 2 1) 2 (4 5) 5)
+
+(list (take s 2) (drop s 4) (member 3 s) (member 9 s))
+; expect ((1 2) (5) (3 4 5) #f)
+
+(drop s 6)
+; expect Error: index 6 out of range for drop
+
+(assoc '(b) '((a 1) ((b) 2)))
+; expect ((b) 2)
+
+(list (fold-left - 0 '(1 2 3)) (fold-right - 0 '(1 2 3)))
+; expect (-6 2)
+
+(sort '((b 2) (a 1) (c 1)) (lambda (x y) (< (car (cdr x)) (car (cdr y)))))
+; expect ((a 1) (c 1) (b 2))
+
+(length (reverse (iota 100000)))
+; expect 100000
+;;; Parallel map and futures
+
+(define offset 1)
+(define (square-plus x) (+ (* x x) offset))
+(parallel-map square-plus (iota 6))
+; expect (1 2 5 10 17 26)
+
+(define (make-adder n) (lambda (x) (+ x n)))
+(parallel-map (make-adder 5) '(1 2 3) 2)
+; expect (6 7 8)
+
+(define f (future (square-plus 3)))
+(list (touch f) (touch 4))
+; expect (10 4)
+
+(touch (future (car '())))
+; expect Error: argument 0 of car has wrong type (nil)
+
 ;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
 ;;; Move the following (exit) line down the file to run additional tests. ;;;
 ;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;